@@ -17,6 +17,9 @@ def _force_s3_storage(cr, registry):
         # We need all attachments, bypass regular search
         ids = models.Model._search(IrAttachment, [])
         for attachment in IrAttachment.browse(ids):
+            if not attachment.store_fname:
+                # Stored in the database
+                continue
             exists = False
             try:
                 attachment._s3_put(attachment.store_fname, content_type=attachment.mimetype)
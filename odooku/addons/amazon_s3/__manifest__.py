@@ -6,7 +6,10 @@
   'category': 'Hidden',
   'author': 'Raymond Reggers',
   'depends': ['base'],
-  'data': [],
+  'data': [
+    'security/ir.model.access.csv',
+    'data/ir_cron.xml',
+  ],
   'auto_install': True,
   'post_init_hook': '_force_s3_storage',
 }
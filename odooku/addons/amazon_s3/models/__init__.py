@@ -1 +1,3 @@
 import ir_attachment
+import ir_http
+import s3_pending_delete
@@ -1,29 +1,78 @@
 import os
+import shutil
+import hashlib
+import binascii
+import tempfile
 import logging
 
 from odoo import api, fields, models, tools, _
 
 from botocore.exceptions import ClientError
+from gevent.pool import Pool
 
-from odooku.s3 import pool as s3_pool, S3Error, S3NoSuchKey, S3_CACHE_TIME
+from odooku.s3 import pool as s3_pool, S3Error, S3NoSuchKey, S3_CACHE_TIME, S3_DELETE_BATCH
 
 
 _logger = logging.getLogger(__name__)
 
 
+S3_GC_LIMIT = 10000
+# Attachments smaller than this number of bytes are stored in the
+# database instead of S3, see the amazon_s3.db_threshold parameter.
+S3_DB_THRESHOLD = 0
+S3_REBALANCE_LIMIT = 1000
+INDEX_LIMIT = 100
+# Concurrent S3 downloads per read, leaves the rest of the
+# S3 pool to other greenlets.
+S3_PREFETCH_CONCURRENCY = 3
+
+# Uploads are decoded in chunks (a multiple of 4 base64 characters) into
+# a temporary file, which is kept in memory up until SPOOL_MAX_SIZE bytes.
+CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def spool_base64(value):
+    """ Decodes a base64 value into a spooled temporary file, returns
+    the file along with its size and SHA1 checksum. """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    sha = hashlib.sha1()
+    size = 0
+    remainder = ''
+    for i in xrange(0, len(value or ''), CHUNK_SIZE):
+        chunk = remainder + ''.join(value[i:i + CHUNK_SIZE].split())
+        end = len(chunk) - len(chunk) % 4
+        chunk, remainder = chunk[:end], chunk[end:]
+        bin_data = binascii.a2b_base64(chunk)
+        sha.update(bin_data)
+        size += len(bin_data)
+        spool.write(bin_data)
+    if remainder:
+        bin_data = binascii.a2b_base64(remainder)
+        sha.update(bin_data)
+        size += len(bin_data)
+        spool.write(bin_data)
+    spool.seek(0)
+    return spool, size, sha.hexdigest()
+
+
 class IrAttachment(models.Model):
 
     _inherit = 'ir.attachment'
 
     s3_exists = fields.Boolean(string='Exists in S3 bucket', default=None)
+    index_pending = fields.Boolean(string='Pending content indexation', index=True)
 
     @api.depends('store_fname', 'db_datas')
     def _compute_datas(self):
         bin_size = self._context.get('bin_size')
+        errors = self._s3_prefetch(self)
         for attach in self:
             if attach.store_fname:
                 no_data = True
                 try:
+                    if attach.store_fname in errors:
+                        raise errors[attach.store_fname]
                     attach.datas = self._file_read(attach.store_fname, bin_size, attach.s3_exists)
                     no_data = False
                 except S3NoSuchKey:
@@ -39,33 +88,42 @@ class IrAttachment(models.Model):
             else:
                 attach.datas = attach.db_datas
 
+    @api.model
+    def _db_threshold(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'amazon_s3.db_threshold', S3_DB_THRESHOLD))
+
     def _inverse_datas(self):
         location = self._storage()
+        threshold = self._db_threshold()
         for attach in self:
-            # compute the fields that depend on datas
+            # compute the fields that depend on datas, full-text
+            # indexation is left to _index_pending.
             value = attach.datas
-            bin_data = value and value.decode('base64') or ''
+            spool, file_size, checksum = spool_base64(value)
             vals = {
-                'file_size': len(bin_data),
-                'checksum': self._compute_checksum(bin_data),
-                'index_content': self._index(bin_data, attach.datas_fname, attach.mimetype),
+                'file_size': file_size,
+                'checksum': checksum,
+                'index_content': False,
+                'index_pending': bool(value),
                 'store_fname': False,
                 'db_datas': value,
             }
-            if value and location != 'db':
-                # save it to the filestore
-                vals['store_fname'] = self._file_write(value, vals['checksum'])
-                vals['db_datas'] = False
-
-                if s3_pool:
-                    s3_exists = True
-                    try:
-                        self._s3_put(vals['store_fname'], content_type=attach.mimetype)
-                    except S3Error:
-                        s3_exists = False
-                    vals.update({ 's3_exists': s3_exists })
-                else:
-                    _logger.warning("S3 is not enabled, dataloss for attachment [%s] is imminent", attach.id)
+            with spool:
+                if value and location != 'db' and file_size >= threshold:
+                    # save it to the filestore
+                    vals['store_fname'] = self._file_write_stream(spool, checksum)
+                    vals['db_datas'] = False
+
+                    if s3_pool:
+                        s3_exists = True
+                        try:
+                            self._s3_put(vals['store_fname'], content_type=attach.mimetype)
+                        except S3Error:
+                            s3_exists = False
+                        vals.update({ 's3_exists': s3_exists })
+                    else:
+                        _logger.warning("S3 is not enabled, dataloss for attachment [%s] is imminent", attach.id)
 
             # take current location in filestore to possibly garbage-collect it
             fname = attach.store_fname
@@ -74,6 +132,111 @@ class IrAttachment(models.Model):
             if fname:
                 self._file_delete(fname)
 
+    @api.model
+    def _file_write_stream(self, fileobj, checksum):
+        fname, full_path = self._get_path(None, checksum)
+        if not os.path.exists(full_path):
+            try:
+                with open(full_path, 'wb') as fp:
+                    shutil.copyfileobj(fileobj, fp)
+                # add fname to checklist, in case the transaction aborts
+                self._mark_for_gc(fname)
+            except IOError:
+                _logger.info("_file_write_stream writing %s", full_path, exc_info=True)
+        return fname
+
+    @api.model
+    def _index_pending(self, limit=INDEX_LIMIT):
+        cr = self._cr
+        cr.execute("SELECT id FROM ir_attachment WHERE index_pending LIMIT %s", (limit,))
+        ids = [row[0] for row in cr.fetchall()]
+        for attach in self.sudo().with_context(bin_size=False).browse(ids):
+            value = attach.datas
+            bin_data = value and value.decode('base64') or ''
+            super(IrAttachment, attach).write({
+                'index_content': self._index(bin_data, attach.datas_fname, attach.mimetype),
+                'index_pending': False
+            })
+
+    @api.model
+    def _s3_rebalance(self, limit=S3_REBALANCE_LIMIT):
+        """ Move attachments between the database and the filestore after
+        the size threshold has been changed. """
+        if self._storage() == 'db':
+            return
+
+        threshold = self._db_threshold()
+        if not threshold:
+            # Nothing is stored in the database on purpose, attachments
+            # already stored there are left as is.
+            return
+
+        cr = self._cr
+        cr.execute("""
+            (SELECT id FROM ir_attachment
+             WHERE type = 'binary' AND store_fname IS NOT NULL AND file_size < %s
+             LIMIT %s)
+            UNION ALL
+            (SELECT id FROM ir_attachment
+             WHERE type = 'binary' AND store_fname IS NULL AND db_datas IS NOT NULL AND file_size >= %s
+             LIMIT %s)
+        """, (threshold, limit, threshold, limit))
+        ids = [row[0] for row in cr.fetchall()]
+        if not ids:
+            return
+
+        _logger.info("Rebalancing %s attachments (threshold %s bytes)", len(ids), threshold)
+        # Contents are moved between the tiers directly, one attachment at a
+        # time since prefetching would load all of them into memory. Going
+        # through datas would clear attachments that could not be read.
+        Attachment = self.sudo().with_context(bin_size=False)
+        for attach_id in ids:
+            attach = Attachment.browse(attach_id)
+            if attach.store_fname:
+                self._s3_rebalance_to_db(attach)
+            else:
+                self._s3_rebalance_to_filestore(attach)
+            attach.invalidate_cache(['datas', 'db_datas'], [attach_id])
+
+    @api.model
+    def _s3_rebalance_to_db(self, attach):
+        fname = attach.store_fname
+        try:
+            value = self._file_read(fname, s3_exists=attach.s3_exists)
+        except S3Error:
+            value = False
+        if not value and attach.file_size:
+            _logger.warning("Rebalancing skipped, could not read attachment [%s]", attach.id)
+            return
+
+        super(IrAttachment, attach).write({
+            'db_datas': value,
+            'store_fname': False,
+            's3_exists': False,
+        })
+        self._file_delete(fname)
+
+    @api.model
+    def _s3_rebalance_to_filestore(self, attach):
+        if not s3_pool:
+            # The local filestore alone does not survive a restart
+            return
+
+        spool, file_size, checksum = spool_base64(attach.db_datas)
+        with spool:
+            fname = self._file_write_stream(spool, checksum)
+        try:
+            self._s3_put(fname, content_type=attach.mimetype)
+        except S3Error:
+            _logger.warning("Rebalancing skipped, could not upload attachment [%s]", attach.id)
+            return
+
+        super(IrAttachment, attach).write({
+            'db_datas': False,
+            'store_fname': fname,
+            's3_exists': True,
+        })
+
     @api.model
     def _file_read(self, fname, bin_size=False, s3_exists=None):
         full_path = self._full_path(fname)
@@ -89,21 +252,54 @@ class IrAttachment(models.Model):
     @api.model
     def _file_delete(self, fname):
         if s3_pool:
-            # using SQL to include files hidden through unlink or due to record rules
-            cr = self._cr
-            cr.execute("SELECT COUNT(*) FROM ir_attachment WHERE store_fname = %s", (fname,))
-            count = cr.fetchone()[0]
-            if not count:
-                key = self._s3_key(fname)
-                _logger.info("S3 (%s) delete '%s'", s3_pool.bucket, key)
-                _logger.increment("s3.delete", 1)
-                try:
-                    s3_pool.client.delete_object(Bucket=s3_pool.bucket, Key=key)
-                except ClientError as e:
-                    if e.response['Error']['Code'] != "NoSuchKey":
-                        _logger.warning("S3 (%s) delete '%s'", s3_pool.bucket, key, exc_info=True)
+            # Deleting from S3 is deferred to _s3_gc, which verifies the file
+            # is no longer referenced once the transaction has been comitted.
+            self._cr.execute("INSERT INTO s3_pending_delete (store_fname) VALUES (%s)", (fname,))
         return super(IrAttachment, self)._file_delete(fname)
 
+    @api.model
+    def _s3_gc(self, limit=S3_GC_LIMIT):
+        if not s3_pool:
+            return
+
+        cr = self._cr
+        # Same as the regular filestore gc, the lock has to be the first
+        # statement of the transaction. Pending files read before it would
+        # be checked against a snapshot missing attachments created while
+        # waiting for the lock. Every batch is committed on its own so
+        # writes to ir_attachment are only blocked for one DeleteObjects.
+        cr.commit()
+        total = 0
+        while total < limit:
+            cr.execute("LOCK ir_attachment IN SHARE MODE")
+            cr.execute("SELECT DISTINCT store_fname FROM s3_pending_delete LIMIT %s",
+                (min(S3_DELETE_BATCH, limit - total),))
+            fnames = [row[0] for row in cr.fetchall()]
+            if not fnames:
+                cr.commit()
+                break
+
+            # using SQL to include files hidden through unlink or due to record rules
+            cr.execute("""
+                SELECT d.fname FROM unnest(%s) AS d(fname)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM ir_attachment a WHERE a.store_fname = d.fname
+                )
+            """, (fnames,))
+            orphans = [row[0] for row in cr.fetchall()]
+
+            failed = set(s3_pool.delete_keys([self._s3_key(fname) for fname in orphans]))
+            done = [fname for fname in fnames if self._s3_key(fname) not in failed]
+            if done:
+                cr.execute("DELETE FROM s3_pending_delete WHERE store_fname IN %s", (tuple(done),))
+            cr.commit()
+            _logger.info("S3 (%s) gc: %d orphaned out of %d pending, %d failed",
+                s3_pool.bucket, len(orphans), len(fnames), len(failed))
+
+            total += len(fnames)
+            if len(fnames) < S3_DELETE_BATCH or not done:
+                break
+
     @api.model
     def _s3_key(self, fname):
         return 'filestore/%s/%s' % (self._cr.dbname, fname)
@@ -115,36 +311,65 @@ class IrAttachment(models.Model):
         _logger.increment("s3.get", 1)
 
         try:
-            r = s3_pool.client.get_object(Bucket=s3_pool.bucket, Key=key)
+            with s3_pool.checkout() as client:
+                r = client.get_object(Bucket=s3_pool.bucket, Key=key)
+                bin_data = r['Body'].read()
         except ClientError as e:
             _logger.warning("S3 (%s) get '%s'", s3_pool.bucket, key, exc_info=True)
             if e.response['Error']['Code'] == "NoSuchKey":
                 raise S3NoSuchKey
             raise S3Error
 
-        bin_data = r['Body'].read()
         checksum = self._compute_checksum(bin_data)
         value = bin_data.encode('base64')
         super(IrAttachment, self)._file_write(value, checksum)
 
     @api.model
-    def _s3_put(self, fname, content_type='application/octet-stream'):
-        value = super(IrAttachment, self)._file_read(fname)
-        bin_data = value.decode('base64')
+    def _s3_prefetch(self, attachments):
+        """ Fetch the files of multiple attachments missing from the local
+        filestore concurrently. Returns the S3 errors by file name. """
+        errors = {}
+        if not s3_pool:
+            return errors
+
+        fnames = set(
+            attach.store_fname for attach in attachments
+            if attach.store_fname and attach.s3_exists
+            and not os.path.exists(self._full_path(attach.store_fname))
+        )
 
+        # A single miss is left to _file_read
+        if len(fnames) < 2:
+            return errors
+
+        def fetch(fname):
+            try:
+                self._s3_get(fname)
+            except S3Error as e:
+                errors[fname] = e
+
+        pool = Pool(min(len(fnames), S3_PREFETCH_CONCURRENCY, max(1, s3_pool.maxconn // 4)))
+        pool.map(fetch, fnames)
+        return errors
+
+    @api.model
+    def _s3_put(self, fname, content_type='application/octet-stream'):
         key = self._s3_key(fname)
         _logger.info("S3 (%s) put '%s'", s3_pool.bucket, key)
         _logger.increment("s3.put", 1)
 
         try:
-            s3_pool.client.put_object(
-                Bucket=s3_pool.bucket,
-                Key=key,
-                Body=bin_data,
-                ContentType=content_type,
-                ACL='public-read',
-                CacheControl=('max-age=%d, public' % (S3_CACHE_TIME))
-            )
-        except ClientError:
+            # Stream the file from the local filestore
+            with open(self._full_path(fname), 'rb') as fp:
+                with s3_pool.checkout() as client:
+                    client.put_object(
+                        Bucket=s3_pool.bucket,
+                        Key=key,
+                        Body=fp,
+                        ContentType=content_type,
+                        ACL='public-read',
+                        CacheControl=('max-age=%d, public' % (S3_CACHE_TIME))
+                    )
+        except (ClientError, IOError):
             _logger.warning("S3 (%s) put '%s'", s3_pool.bucket, key, exc_info=True)
             raise S3Error
@@ -0,0 +1,85 @@
+import logging
+
+from werkzeug.routing import RequestRedirect
+from werkzeug.urls import url_quote
+
+from odoo import models
+from odoo.exceptions import AccessError
+from odoo.http import request
+
+from odooku.s3 import pool as s3_pool
+from odooku.params import params
+
+S3_REDIRECT = getattr(params, 'S3_REDIRECT', False)
+
+
+_logger = logging.getLogger(__name__)
+
+
+class S3Redirect(RequestRedirect):
+    # Presigned urls expire, never let the redirect be cached permanently
+    code = 302
+
+
+class IrHttp(models.AbstractModel):
+
+    _inherit = 'ir.http'
+
+    @classmethod
+    def _s3_redirect_allowed(cls):
+        # Resized images still have to pass through the worker
+        args = dict(request.params)
+        args.update(getattr(request, 'endpoint_arguments', None) or {})
+        return not any(args.get(key) for key in ['width', 'height', 'resize'])
+
+    @classmethod
+    def _s3_redirect_url(cls, attachment, filename=None, download=False, mimetype=None):
+        key = attachment._s3_key(attachment.store_fname)
+        if attachment.public and not download:
+            return s3_pool.get_url(key)
+
+        filename = filename or attachment.datas_fname or attachment.name
+        return s3_pool.get_presigned_url(
+            key,
+            ResponseContentType=(mimetype or attachment.mimetype or 'application/octet-stream'),
+            ResponseContentDisposition=('%s; filename*=UTF-8\'\'%s' % (
+                'attachment' if download else 'inline',
+                url_quote(filename or '')
+            ))
+        )
+
+    @classmethod
+    def binary_content(cls, xmlid=None, model='ir.attachment', id=None, field='datas',
+            unique=False, filename=None, filename_field='datas_fname', download=False,
+            mimetype=None, default_mimetype='application/octet-stream', env=None):
+        if (S3_REDIRECT and s3_pool and request
+                and model == 'ir.attachment' and field == 'datas'
+                and cls._s3_redirect_allowed()):
+            env = env or request.env
+            obj = None
+            if xmlid:
+                obj = env.ref(xmlid, False)
+            elif id:
+                obj = env[model].browse(int(id))
+
+            if obj and obj._name == 'ir.attachment' and obj.exists():
+                # check read access
+                try:
+                    obj['__last_update']
+                except AccessError:
+                    return (403, [], None)
+
+                if obj.type == 'binary' and obj.store_fname and obj.s3_exists:
+                    _logger.increment("s3.redirect", 1)
+                    raise S3Redirect(cls._s3_redirect_url(
+                        obj,
+                        filename=filename,
+                        download=download,
+                        mimetype=mimetype
+                    ))
+
+        return super(IrHttp, cls).binary_content(
+            xmlid=xmlid, model=model, id=id, field=field, unique=unique,
+            filename=filename, filename_field=filename_field, download=download,
+            mimetype=mimetype, default_mimetype=default_mimetype, env=env
+        )
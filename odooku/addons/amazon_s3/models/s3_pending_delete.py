@@ -0,0 +1,10 @@
+from odoo import fields, models
+
+
+class S3PendingDelete(models.Model):
+
+    _name = 's3.pending.delete'
+    _description = 'S3 pending delete'
+    _log_access = False
+
+    store_fname = fields.Char(string='Stored Filename', required=True, index=True)
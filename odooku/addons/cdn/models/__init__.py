@@ -1 +1,2 @@
+import ir_attachment
 import ir_qweb
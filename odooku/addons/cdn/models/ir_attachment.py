@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+from .ir_qweb import clear_cdn_cache
+
+
+CDN_FIELDS = ['url', 'datas', 'store_fname', 'public']
+
+
+class IrAttachment(models.Model):
+
+    _inherit = 'ir.attachment'
+
+    @api.multi
+    def _cdn_invalidate(self, vals=None):
+        clear_cdn_cache(self.env.cr.dbname)
+        # Only public attachments with an url are mapped, clearing the
+        # caches bumps the cache sequence which invalidates the mappings
+        # of other processes as well. Attachments becoming public or
+        # getting an url are checked by their new values.
+        vals = vals or {}
+        if (vals.get('url') or vals.get('public')
+                or self.sudo().filtered(lambda attach: attach.url and attach.public)):
+            self.env['ir.qweb'].clear_caches()
+
+    @api.multi
+    def write(self, vals):
+        if any(field in vals for field in CDN_FIELDS):
+            self._cdn_invalidate(vals)
+        return super(IrAttachment, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._cdn_invalidate()
+        return super(IrAttachment, self).unlink()
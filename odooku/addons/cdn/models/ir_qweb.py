@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 
 import ast
+import re
+import threading
 
 import odoo
-from odoo import models, tools, SUPERUSER_ID
+from odoo import api, models, tools, SUPERUSER_ID
 from odoo.http import request
 from odoo.addons.base.ir.ir_qweb.assetsbundle import AssetsBundle
 
 from odooku.s3 import pool as s3_pool
+from odooku.cdn import static_key
 from odooku.params import params
 
 CDN_ENABLED = getattr(params, 'CDN_ENABLED', False)
 
+# Attachment url to CDN url mapping per database, only
+# filled for attachments that are public.
+CDN_CACHE_SIZE = 10000
+_cdn_cache = {}
+
+# Attachment urls are resolved in a single query at the end
+# of a render, until then placeholders are rendered.
+CDN_PLACEHOLDER = '__odooku_cdn_%d__'
+CDN_PLACEHOLDER_RE = re.compile(r'__odooku_cdn_(\d+)__')
+_local = threading.local()
+
+
+def clear_cdn_cache(db_name):
+    _cdn_cache.pop(db_name, None)
+
 
 class IrQWeb(models.AbstractModel):
 
@@ -23,21 +41,86 @@ class IrQWeb(models.AbstractModel):
         'img':     'src',
     }
 
+    def _cdn_cache(self):
+        registry = self.env.registry
+        cache_sequence, cache = _cdn_cache.get(registry.db_name, (None, None))
+        if cache is None or cache_sequence != registry.cache_sequence or len(cache) > CDN_CACHE_SIZE:
+            cache = {}
+            _cdn_cache[registry.db_name] = (registry.cache_sequence, cache)
+        return cache
+
+    def _cdn_attachment_urls(self, urls):
+        cache = self._cdn_cache()
+        result = dict((url, cache[url]) for url in urls if url in cache)
+        misses = set(urls) - set(result)
+        if misses:
+            IrAttachment = self.env['ir.attachment']
+            attachments = IrAttachment.search_read(
+                [('url', 'in', list(misses))],
+                ['url', 'store_fname', 'public']
+            )
+            for attachment in attachments:
+                url = attachment['url']
+                if url in result or not attachment['store_fname']:
+                    continue
+                # /filestore/<dbname/<attachment>
+                result[url] = s3_pool.get_url('filestore', self.env.cr.dbname, attachment['store_fname'])
+                if attachment['public']:
+                    cache[url] = result[url]
+            for url in misses - set(result):
+                result[url] = cache[url] = url
+        return result
+
+    def _cdn_render(self, render):
+        pending = []
+        previous = getattr(_local, 'pending', None)
+        _local.pending = pending
+        try:
+            result = render()
+        finally:
+            _local.pending = previous
+
+        if pending:
+            urls = self._cdn_attachment_urls(pending)
+            # Renders result in utf-8 encoded strings, assets in unicode
+            encode = isinstance(result, str)
+
+            def replace(match):
+                url = tools.html_escape(urls[pending[int(match.group(1))]])
+                if encode and isinstance(url, unicode):
+                    url = url.encode('utf-8')
+                return url
+
+            result = CDN_PLACEHOLDER_RE.sub(replace, result)
+        return result
+
     def _cdn_url(self, url):
         parts = url.split('/')
-        cr, env = request.cr, request.env
         if url.startswith('/web/content/'):
-            IrAttachment = env['ir.attachment']
-            attachments = IrAttachment.search([('url', '=like', url)])
-            if attachments:
-                # /filestore/<dbname/<attachment>
-                url = s3_pool.get_url('filestore', cr.dbname, attachments[0].store_fname)
+            cache = self._cdn_cache()
+            pending = getattr(_local, 'pending', None)
+            if url in cache:
+                url = cache[url]
+            elif pending is not None:
+                pending.append(url)
+                url = CDN_PLACEHOLDER % (len(pending) - 1)
+            else:
+                url = self._cdn_attachment_urls([url])[url]
         elif len(parts) > 3 and parts[2] == 'static':
             # /<module>/static
-            url = s3_pool.get_url(url[1:])
+            key, sep, query = url[1:].partition('?')
+            url = s3_pool.get_url(static_key(s3_pool, key)) + sep + query
 
         return url
 
+    @api.model
+    def render(self, id_or_xml_id, values=None, **options):
+        if not CDN_ENABLED or not s3_pool:
+            return super(IrQWeb, self).render(id_or_xml_id, values=values, **options)
+        return self._cdn_render(
+            lambda: super(IrQWeb, self).render(id_or_xml_id, values=values, **options)
+        )
+
     def _cdn_build_attribute(self, tagName, name, value, options, values):
         return self._cdn_url(value)
 
@@ -108,7 +191,10 @@ class IrQWeb(models.AbstractModel):
         files, remains = self._get_asset_content(xmlid, options)
         asset = AssetsBundle(xmlid, files, remains, env=self.env)
         url_for = (values or {}).get('url_for', lambda url: url)
-        cdn_url_for = url_for
         if CDN_ENABLED and s3_pool:
+            # Resolve attachment urls before caching the result
             cdn_url_for = lambda url: self._cdn_url(url_for(url))
-        return asset.to_html(css=css, js=js, debug=debug, async=async, url_for=cdn_url_for)
+            return self._cdn_render(
+                lambda: asset.to_html(css=css, js=js, debug=debug, async=async, url_for=cdn_url_for)
+            )
+        return asset.to_html(css=css, js=js, debug=debug, async=async, url_for=url_for)
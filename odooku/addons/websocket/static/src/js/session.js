@@ -5,6 +5,11 @@ odoo.define('websocket.Session', function(require) {
   var WebSocket = require('websocket.WebSocket');
   var Session = require('web.Session');
 
+  // Matches the server side longpolling timeout
+  var POLL_TIMEOUT = 25000;
+  // Server is too busy to handle the request through the socket
+  var WS_BUSY_CODE = -32000;
+
   Session.include({
 
     setup: function() {
@@ -25,8 +30,17 @@ odoo.define('websocket.Session', function(require) {
         }
       };
 
-      return this.ws.send(data).then(
+      if (options && options.ws_subscribe) {
+        data.subscribe = true;
+      }
+
+      // Longpolling requests are not batched, they are answered separately
+      var send = data.subscribe ? this.ws.send(data) : this.ws.send_batched(data);
+      return send.then(
         function(result) {
+          if (result.error && result.error.code === WS_BUSY_CODE) {
+            return $.Deferred().reject('websocket:busy', result.error);
+          }
           core.bus.trigger('rpc:result', data, result);
           if (result.error) {
             return $.Deferred().reject('rpc', result.error);
@@ -80,9 +94,29 @@ odoo.define('websocket.Session', function(require) {
       });
     },
 
+    ws_poll: function(url, params, options, fallback) {
+      // The server answers right away and subscribes the socket to the
+      // polled channels, wait for pushed notifications instead.
+      var ws = this.ws;
+      options = _.extend({}, options, {ws_subscribe: true});
+      return this.ws_rpc(url, params, options, fallback).then(function(result) {
+        // Presence (negative ids) is returned on every poll, only
+        // actual notifications answer the poll right away.
+        if (_.some(result || [], function(notification) { return notification.id >= 0; })) {
+          return result;
+        }
+        return ws.wait_bus(POLL_TIMEOUT).then(function(notifications) {
+          return (result || []).concat(notifications);
+        });
+      });
+    },
+
     rpc: function(url, params, options) {
       var fallback = this._super.bind(this, url, params, options);
       if (this.ws && this.ws.enabled()) {
+        if (url === '/longpolling/poll') {
+          return this.ws_poll(url, params, options, fallback);
+        }
         return this.ws_rpc(url, params, options, fallback);
       } else {
         return fallback();
@@ -3,6 +3,9 @@ odoo.define('websocket.WebSocket', function(require) {
 
   var core = require('web.core');
 
+  // Matches the server side limit of calls per batch message
+  var WS_MAX_BATCH = 10;
+
   var _WebSocket = core.Class.extend({
 
     init: function(uri) {
@@ -14,6 +17,9 @@ odoo.define('websocket.WebSocket', function(require) {
       this._onmessage = this._onmessage.bind(this);
       this._onerror = this._onerror.bind(this);
       this._reachable = null; // Indicates if the socket managed to connect at least once
+      this._bus_notifications = []; // Pushed bus notifications, see wait_bus
+      this._bus_waiter = null;
+      this._batch = null; // Queued [data, deferred] pairs, see send_batched
     },
 
     enabled: function() {
@@ -47,6 +53,9 @@ odoo.define('websocket.WebSocket', function(require) {
         _.forEach(this._requests, function(d) {
           d.reject('websocket:close', evt);
         });
+
+        // Bus subscriptions are lost along with the socket
+        this._resolve_bus();
       }
     },
 
@@ -56,11 +65,43 @@ odoo.define('websocket.WebSocket', function(require) {
         if (this._requests && this._requests.hasOwnProperty(message.id)) {
           this._requests[message.id].resolve(message.payload);
         }
+      } else if (message.bus) {
+        this._bus_notifications = this._bus_notifications.concat(message.bus);
+        this._resolve_bus();
       } else {
         // Ping
       }
     },
 
+    _resolve_bus: function() {
+      if (this._bus_waiter) {
+        var d = this._bus_waiter;
+        var notifications = this._bus_notifications;
+        this._bus_waiter = null;
+        this._bus_notifications = [];
+        d.resolve(notifications);
+      }
+    },
+
+    wait_bus: function(timeout) {
+      // Resolves with the bus notifications pushed through the socket,
+      // or an empty list after timeout.
+      var self = this;
+      var d = $.Deferred();
+      this._resolve_bus();
+      this._bus_waiter = d;
+      if (this._bus_notifications.length) {
+        this._resolve_bus();
+      } else {
+        setTimeout(function() {
+          if (self._bus_waiter === d) {
+            self._resolve_bus();
+          }
+        }, timeout);
+      }
+      return d;
+    },
+
     _onerror: function(evt) {
       if (this._ws === evt.target && this._ws.readyState !== WebSocket.OPEN) {
         // Our current websocket is not available (anymore), close it.
@@ -125,6 +166,51 @@ odoo.define('websocket.WebSocket', function(require) {
       return d;
     },
 
+    send_batched: function(data) {
+      // Calls made within the same tick are sent as a single
+      // batch message and answered with a single response.
+      var self = this;
+      var d = $.Deferred();
+      if (!this._batch) {
+        this._batch = [];
+        setTimeout(function() {
+          self._flush_batch();
+        }, 0);
+      }
+      this._batch.push([data, d]);
+      return d;
+    },
+
+    _flush_batch: function() {
+      var batches = [];
+      for (var i = 0; i < this._batch.length; i += WS_MAX_BATCH) {
+        batches.push(this._batch.slice(i, i + WS_MAX_BATCH));
+      }
+      this._batch = null;
+      _.each(batches, this._send_batch, this);
+    },
+
+    _send_batch: function(batch) {
+      if (batch.length === 1) {
+        this.send(batch[0][0]).then(batch[0][1].resolve, batch[0][1].reject);
+        return;
+      }
+
+      this.send({batch: _.map(batch, function(item) {
+        return item[0];
+      })}).then(function(payload) {
+        _.each(batch, function(item, index) {
+          // The batch as a whole might have been rejected
+          item[1].resolve(payload && payload.batch ? payload.batch[index] : payload);
+        });
+      }, function() {
+        var args = arguments;
+        _.each(batch, function(item) {
+          item[1].reject.apply(item[1], args);
+        });
+      });
+    },
+
     destroy: function() {
       if (this._ws) {
         this._ws.close();
@@ -0,0 +1,97 @@
+import json
+import hashlib
+import logging
+import posixpath
+
+from botocore.exceptions import ClientError
+
+from odooku.s3 import S3Error
+
+
+_logger = logging.getLogger(__name__)
+
+
+# Content hashes of the static files uploaded by `odooku cdn collect`
+MANIFEST_KEY = 'static-manifest.json'
+# Bumped whenever the uploaded keys change, an outdated
+# manifest causes all files to be uploaded again.
+MANIFEST_VERSION = 2
+
+CHUNK_SIZE = 64 * 1024
+
+# Static files are also uploaded under a content hashed key, which
+# never changes and can therefore be cached forever.
+HASH_LENGTH = 12
+IMMUTABLE_CACHE_CONTROL = 'max-age=31536000, public, immutable'
+
+
+def hashed_key(key, hash):
+    root, ext = posixpath.splitext(key)
+    return '%s.%s%s' % (root, hash[:HASH_LENGTH], ext)
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_manifest(pool):
+    try:
+        with pool.checkout() as client:
+            r = client.get_object(Bucket=pool.bucket, Key=MANIFEST_KEY)
+            manifest = json.loads(r['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] != "NoSuchKey":
+            _logger.warning("S3 (%s) get '%s'", pool.bucket, MANIFEST_KEY, exc_info=True)
+            raise S3Error
+        manifest = {}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'files': {},
+            'retired': []
+        }
+    return manifest
+
+
+_static_files = None
+
+def static_files(pool):
+    """ Static files of the manifest, loaded once per process. """
+    global _static_files
+    if _static_files is None:
+        try:
+            _static_files = load_manifest(pool)['files']
+        except S3Error:
+            _static_files = {}
+    return _static_files
+
+
+def static_key(pool, key):
+    """ Returns the content hashed key for a static file, if any. """
+    entry = static_files(pool).get(key)
+    if entry:
+        return hashed_key(key, entry['hash'])
+    return key
+
+
+def save_manifest(pool, manifest):
+    try:
+        with pool.checkout() as client:
+            client.put_object(
+                Bucket=pool.bucket,
+                Key=MANIFEST_KEY,
+                Body=json.dumps(manifest, sort_keys=True),
+                ContentType='application/json',
+                CacheControl='no-cache'
+            )
+    except ClientError:
+        _logger.warning("S3 (%s) put '%s'", pool.bucket, MANIFEST_KEY, exc_info=True)
+        raise S3Error
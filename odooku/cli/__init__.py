@@ -39,6 +39,16 @@ import logging
     envvar="REDIS_URL",
     help="redis://[password]@[host]:[port]/[database number]"
 )
+@click.option(
+    '--redis-bus',
+    is_flag=True,
+    envvar=prefix_envvar('REDIS_BUS'),
+    help="""
+    Fan out bus notifications over Redis pub/sub instead of
+    Postgres NOTIFY. Every process sending or receiving bus
+    notifications has to use the same transport.
+    """
+)
 @click.option(
     '--aws-access-key-id',
     envvar="AWS_ACCESS_KEY_ID",
@@ -75,6 +85,15 @@ import logging
     type=click.Choice(['path', 'virtual']),
     help="S3 addressing style."
 )
+@click.option(
+    '--s3-maxconn',
+    default=10,
+    envvar=prefix_envvar("S3_MAXCONN"),
+    type=click.INT,
+    help="""
+    Maximum number of S3 clients per worker.
+    """
+)
 @click.option(
     '--addons',
     required=True,
@@ -96,9 +115,9 @@ import logging
     envvar=prefix_envvar('STATSD_HOST')
 )
 @click.pass_context
-def main(ctx, database_url, database_maxconn, redis_url, redis_maxconn,
+def main(ctx, database_url, database_maxconn, redis_url, redis_maxconn, redis_bus,
         aws_access_key_id, aws_secret_access_key, aws_region, s3_bucket,
-        s3_endpoint_url, s3_custom_domain, s3_addressing_style,
+        s3_endpoint_url, s3_custom_domain, s3_addressing_style, s3_maxconn,
         addons, tmp_dir, debug, statsd_host):
 
     # Setup logger first, then import further modules
@@ -115,6 +134,7 @@ def main(ctx, database_url, database_maxconn, redis_url, redis_maxconn,
         endpoint_url=s3_endpoint_url,
         custom_domain=s3_custom_domain,
         addressing_style=s3_addressing_style,
+        maxconn=s3_maxconn,
     )
 
     # Setup Redis
@@ -127,6 +147,9 @@ def main(ctx, database_url, database_maxconn, redis_url, redis_maxconn,
         maxconn=redis_maxconn
     )
 
+    # Bus transport, shared by all commands
+    params.REDIS_BUS = redis_bus
+
     # Setup Odoo
     import odoo
     from odoo.tools import config
@@ -156,6 +179,9 @@ def main(ctx, database_url, database_maxconn, redis_url, redis_maxconn,
     config['list_db'] = not bool(db_name)
 
     logger = logging.getLogger(__name__)
+    if redis_bus and not redis.pool:
+        logger.warning("Redis bus requires Redis, falling back to Postgres NOTIFY")
+
     ctx.obj.update({
         'debug': debug,
         'config': config,
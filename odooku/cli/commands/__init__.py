@@ -3,6 +3,7 @@ from cron import *
 from database import *
 from data import *
 from cdn import *
+from s3 import *
 from shell import *
 from trans import *
 from runtests import *
@@ -1,5 +1,12 @@
 import click
 import os
+import re
+import gzip
+import mimetypes
+from cStringIO import StringIO
+
+
+from odooku.cli.helpers import resolve_db_name
 
 
 __all__ = [
@@ -9,17 +16,55 @@ __all__ = [
 
 RESERVED = ['filestore']
 
+CALL_ASSETS_RE = re.compile(r't-call-assets="([^"]+)"')
+DEBUG_MODES = [False, 'assets']
+
+COMPRESSIBLE = ['.css', '.js', '.map', '.json', '.svg', '.html', '.xml', '.txt', '.ttf', '.eot']
+
+
+def gzip_file(path):
+    buf = StringIO()
+    # Fixed mtime, keeps the output identical for identical input
+    with open(path, 'rb') as f, gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as z:
+        z.write(f.read())
+    return buf.getvalue()
+
 
 @click.command()
+@click.option(
+    '--workers',
+    type=click.INT,
+    help="Number of concurrent uploads, defaults to the S3 maxconn."
+)
+@click.option(
+    '--gzip',
+    'compress',
+    is_flag=True,
+    help="Upload text assets gzip compressed."
+)
+@click.option(
+    '--force',
+    is_flag=True,
+    help="Ignore the manifest and upload all files."
+)
 @click.pass_context
-def collect(ctx):
+def collect(ctx, workers, compress, force):
     logger = (
         ctx.obj['logger']
     )
 
+    from gevent.pool import Pool
+    from botocore.exceptions import ClientError
     from odoo.modules import get_modules, get_module_path
     from odoo.tools.osutil import listdir
-    from odooku.s3 import pool as s3_pool, S3_CACHE_TIME
+    from odooku.s3 import pool as s3_pool, S3Error, S3_CACHE_TIME
+    from odooku.cdn import (load_manifest, save_manifest, file_hash,
+        hashed_key, IMMUTABLE_CACHE_CONTROL)
+
+    manifest = load_manifest(s3_pool)
+    previous = manifest['files']
+    files = {}
+    uploads = []
 
     for module in get_modules():
         if module in RESERVED:
@@ -30,11 +75,128 @@ def collect(ctx):
             for filename in listdir(static_dir, True):
                 path = os.path.join(static_dir, filename)
                 url = os.path.join(module, 'static', filename)
-                logger.info("Uploading %s", url)
-                s3_pool.client.upload_file(path, s3_pool.bucket, url, ExtraArgs={
-                    'ACL': 'public-read',
-                    'CacheControl': ('max-age=%d, public' % (S3_CACHE_TIME))
-                })
+                files[url] = {
+                    'hash': file_hash(path),
+                    'gzip': compress and os.path.splitext(url)[1] in COMPRESSIBLE,
+                }
+                if force or previous.get(url) != files[url]:
+                    uploads.append((path, url))
+
+    failed = []
+    def upload(item):
+        path, url = item
+        logger.info("Uploading %s", url)
+        extra_args = {
+            'ACL': 'public-read',
+            'CacheControl': ('max-age=%d, public' % (S3_CACHE_TIME)),
+            'ContentType': mimetypes.guess_type(url)[0] or 'application/octet-stream',
+        }
+        try:
+            with s3_pool.checkout() as client:
+                if files[url]['gzip']:
+                    client.put_object(
+                        Bucket=s3_pool.bucket,
+                        Key=url,
+                        Body=gzip_file(path),
+                        ContentEncoding='gzip',
+                        **extra_args
+                    )
+                else:
+                    client.upload_file(path, s3_pool.bucket, url, ExtraArgs=extra_args)
+
+                # Immutable copy under the content hashed key
+                extra_args['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+                if files[url]['gzip']:
+                    extra_args['ContentEncoding'] = 'gzip'
+                client.copy_object(
+                    Bucket=s3_pool.bucket,
+                    Key=hashed_key(url, files[url]['hash']),
+                    CopySource={'Bucket': s3_pool.bucket, 'Key': url},
+                    MetadataDirective='REPLACE',
+                    **extra_args
+                )
+        except (ClientError, S3Error):
+            logger.warning("Failed to upload %s", url, exc_info=True)
+            failed.append(url)
+
+    pool = Pool(workers or s3_pool.maxconn)
+    pool.map(upload, uploads)
+
+    stale = [url for url in previous if url not in files]
+    if stale:
+        logger.info("Removing %s stale files", len(stale))
+        failed.extend(s3_pool.delete_keys(stale))
+
+    # Hashed keys replaced during the previous run are removed now, pages
+    # rendered before this deploy keep working for one more deploy.
+    retired = manifest.get('retired', [])
+    if retired:
+        logger.info("Removing %s retired files", len(retired))
+        retired = s3_pool.delete_keys(retired)
+    for url, entry in previous.iteritems():
+        if url not in failed and files.get(url, {}).get('hash') != entry['hash']:
+            retired.append(hashed_key(url, entry['hash']))
+
+    # Failed files are retried on the next run
+    for url in failed:
+        if url in previous:
+            files[url] = previous[url]
+        else:
+            files.pop(url, None)
+
+    manifest['files'] = files
+    manifest['retired'] = retired
+    save_manifest(s3_pool, manifest)
+    logger.info(
+        "Collected %s files: %s uploaded, %s removed, %s failed",
+        len(files), len(uploads), len(stale), len(failed)
+    )
+
+
+@click.command()
+@click.option(
+    '--db-name',
+    callback=resolve_db_name
+)
+@click.pass_context
+def bundles(ctx, db_name):
+    logger = (
+        ctx.obj['logger']
+    )
+
+    from odoo.modules.registry import RegistryManager
+    from odoo.addons.base.ir.ir_qweb.assetsbundle import AssetsBundle
+    from odooku.api import environment
+
+    registry = RegistryManager.get(db_name)
+    with registry.cursor() as cr:
+        with environment(cr) as env:
+            views = env['ir.ui.view'].search([
+                ('type', '=', 'qweb'),
+                ('arch_db', 'like', 't-call-assets')
+            ])
+            xmlids = sorted(set(
+                xmlid
+                for view in views
+                for xmlid in CALL_ASSETS_RE.findall(view.arch_db)
+                if env.ref(xmlid, False)
+            ))
+            langs = [code for code, name in env['res.lang'].get_installed()]
+
+            for xmlid in xmlids:
+                checksums = set()
+                for lang in langs:
+                    lang_env = env(context=dict(env.context, lang=lang))
+                    files, remains = lang_env['ir.qweb']._get_asset_content(xmlid, {'lang': lang})
+                    asset = AssetsBundle(xmlid, files, remains, env=lang_env)
+                    if asset.checksum in checksums:
+                        continue
+                    checksums.add(asset.checksum)
+                    logger.info("Building %s (%s) %s", xmlid, lang, asset.checksum)
+                    for debug in DEBUG_MODES:
+                        asset.to_html(debug=debug)
+                    # Attachments are stored (and uploaded to S3) per bundle
+                    cr.commit()
 
 
 @click.group()
@@ -44,3 +206,4 @@ def cdn(ctx):
 
 
 cdn.add_command(collect)
+cdn.add_command(bundles)
@@ -116,7 +116,8 @@ def dump(ctx, db_name, s3_file):
 
         t.seek(0)
         if s3_file:
-            s3_pool.client.upload_fileobj(t, s3_pool.bucket, s3_file)
+            with s3_pool.checkout() as client:
+                client.upload_fileobj(t, s3_pool.bucket, s3_file)
         else:
             # Pipe to stdout
             while True:
@@ -153,7 +154,8 @@ def restore(ctx, db_name, copy, s3_file):
 
     with tempfile.NamedTemporaryFile(delete=False) as t:
         if s3_file:
-            s3_pool.client.download_fileobj(s3_pool.bucket, s3_file, t)
+            with s3_pool.checkout() as client:
+                client.download_fileobj(s3_pool.bucket, s3_file, t)
         else:
             # Read from stdin
             while True:
@@ -0,0 +1,178 @@
+import click
+import os
+
+from odooku.cli.helpers import resolve_db_name
+
+
+__all__ = [
+    's3'
+]
+
+
+BATCH_SIZE = 1000
+ITER_SIZE = 10000
+
+
+def iter_attachments(cr):
+    # Server side cursor, attachments are streamed in the same (byte)
+    # order S3 lists its keys in.
+    cursor = cr._cnx.cursor('s3_reconcile')
+    cursor.itersize = ITER_SIZE
+    cursor.execute("""
+        SELECT store_fname, bool_and(s3_exists IS TRUE), bool_and(s3_exists IS FALSE), max(mimetype)
+        FROM ir_attachment
+        WHERE store_fname IS NOT NULL
+        GROUP BY store_fname
+        ORDER BY store_fname COLLATE "C"
+    """)
+    try:
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def iter_keys(client, bucket, prefix):
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key'][len(prefix):]
+
+
+@click.command()
+@click.option(
+    '--db-name',
+    callback=resolve_db_name
+)
+@click.option(
+    '--repair',
+    is_flag=True,
+    help="Upload files missing from S3 that are still in the local filestore."
+)
+@click.option(
+    '--delete-orphans',
+    is_flag=True,
+    help="Delete S3 keys not referenced by any attachment."
+)
+@click.pass_context
+def reconcile(ctx, db_name, repair, delete_orphans):
+    logger = (
+        ctx.obj['logger']
+    )
+
+    from odoo.modules.registry import RegistryManager
+    from odooku.api import environment
+    from odooku.s3 import pool as s3_pool, S3Error
+
+    if not s3_pool:
+        raise click.ClickException("S3 is not enabled")
+
+    registry = RegistryManager.get(db_name)
+    prefix = 'filestore/%s/' % db_name
+    stats = dict(found=0, missing=0, repaired=0, orphans=0, deleted=0)
+
+    with registry.cursor() as cr:
+        with environment(cr) as env:
+            IrAttachment = env['ir.attachment']
+            pending = {True: [], False: []}
+            orphans = []
+
+            # Writes go through separate cursors, the streaming cursor
+            # must not hold locks conflicting with the orphan check.
+            def update(exists, fnames):
+                with registry.cursor() as update_cr:
+                    update_cr.execute(
+                        "UPDATE ir_attachment SET s3_exists = %s WHERE store_fname IN %s",
+                        (exists, tuple(fnames))
+                    )
+
+            def delete(keys):
+                # The stream is a snapshot, files of attachments created
+                # since are listed as well. Same as _s3_gc, check them again
+                # while preventing attachments from being created.
+                with registry.cursor() as gc_cr:
+                    gc_cr.execute("LOCK ir_attachment IN SHARE MODE")
+                    gc_cr.execute("""
+                        SELECT d.fname FROM unnest(%s) AS d(fname)
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM ir_attachment a WHERE a.store_fname = d.fname
+                        )
+                    """, (keys,))
+                    confirmed = [row[0] for row in gc_cr.fetchall()]
+                    if confirmed:
+                        s3_pool.delete_keys([prefix + key for key in confirmed])
+                    stats['deleted'] += len(confirmed)
+
+            def flush(force=False):
+                for exists, fnames in pending.iteritems():
+                    if fnames and (force or len(fnames) >= BATCH_SIZE):
+                        update(exists, fnames)
+                        del fnames[:]
+                if orphans and (force or len(orphans) >= BATCH_SIZE):
+                    if delete_orphans:
+                        delete(orphans)
+                    del orphans[:]
+
+            def found(fname, marked_exists):
+                stats['found'] += 1
+                if not marked_exists:
+                    pending[True].append(fname)
+
+            def missing(fname, marked_missing, mimetype):
+                stats['missing'] += 1
+                if repair and os.path.exists(IrAttachment._full_path(fname)):
+                    try:
+                        IrAttachment._s3_put(fname, content_type=mimetype or 'application/octet-stream')
+                    except S3Error:
+                        pass
+                    else:
+                        stats['repaired'] += 1
+                        pending[True].append(fname)
+                        return
+                logger.warning("S3 (%s) missing '%s'", s3_pool.bucket, prefix + fname)
+                if not marked_missing:
+                    pending[False].append(fname)
+
+            def orphan(key):
+                stats['orphans'] += 1
+                logger.info("S3 (%s) orphan '%s'", s3_pool.bucket, prefix + key)
+                orphans.append(key)
+
+            with s3_pool.checkout() as client:
+                attachments = iter_attachments(cr)
+                keys = iter_keys(client, s3_pool.bucket, prefix)
+                attachment = next(attachments, None)
+                key = next(keys, None)
+
+                # Merge both sorted streams
+                while attachment is not None or key is not None:
+                    if key is None or (attachment is not None and attachment[0] < key):
+                        fname, marked_exists, marked_missing, mimetype = attachment
+                        missing(fname, marked_missing, mimetype)
+                        attachment = next(attachments, None)
+                    elif attachment is None or key < attachment[0]:
+                        orphan(key)
+                        key = next(keys, None)
+                    else:
+                        fname, marked_exists, marked_missing, mimetype = attachment
+                        found(fname, marked_exists)
+                        attachment = next(attachments, None)
+                        key = next(keys, None)
+                    flush()
+
+            flush(force=True)
+
+    logger.info(
+        "S3 (%s) reconciled %s: %s found, %s missing, %s repaired, %s orphans, %s deleted",
+        s3_pool.bucket, db_name, stats['found'], stats['missing'],
+        stats['repaired'], stats['orphans'], stats['deleted']
+    )
+
+
+@click.group()
+@click.pass_context
+def s3(ctx):
+    pass
+
+
+s3.add_command(reconcile)
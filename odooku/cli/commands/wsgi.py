@@ -33,6 +33,12 @@ __all__ = [
     envvar=prefix_envvar('CDN'),
     help="Enables Content Delivery through S3 endpoint or S3 custom domain."
 )
+@click.option(
+    '--s3-redirect',
+    is_flag=True,
+    envvar=prefix_envvar('S3_REDIRECT'),
+    help="Redirect attachment downloads to S3 instead of streaming them."
+)
 @click.option(
     '--proxy-mode',
     is_flag=True,
@@ -53,6 +59,19 @@ __all__ = [
     is_flag=True,
     envvar=prefix_envvar('WS')
 )
+@click.option(
+    '--ws-concurrency',
+    type=click.INT,
+    envvar=prefix_envvar('WS_CONCURRENCY'),
+    help="Websocket messages dispatched concurrently, defaults to half of the database connections."
+)
+@click.option(
+    '--ws-signaling-interval',
+    default=1000,
+    envvar=prefix_envvar('WS_SIGNALING_INTERVAL'),
+    type=click.INT,
+    help="Minimal time in ms between registry signaling checks for websocket messages."
+)
 @click.option(
     '--cron',
     is_flag=True,
@@ -71,8 +90,8 @@ __all__ = [
     envvar=prefix_envvar('DEV')
 )
 @click.pass_context
-def wsgi(ctx, port, timeout, cdn, proxy_mode, admin_password,
-        db_filter, ws, cron, cron_interval, dev):
+def wsgi(ctx, port, timeout, cdn, s3_redirect, proxy_mode, admin_password,
+        db_filter, ws, ws_concurrency, ws_signaling_interval, cron, cron_interval, dev):
 
     debug, config, params, logger = (
         ctx.obj['debug'],
@@ -110,7 +129,10 @@ def wsgi(ctx, port, timeout, cdn, proxy_mode, admin_password,
     # Keep track of custom config params
     params.TIMEOUT = timeout
     params.CDN_ENABLED = cdn
+    params.S3_REDIRECT = s3_redirect
     params.WS_ENABLED = ws
+    params.WS_MAX_CONCURRENCY = ws_concurrency
+    params.WS_SIGNALING_INTERVAL = ws_signaling_interval
 
     def serve():
         max_accept = config['db_maxconn']
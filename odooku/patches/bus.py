@@ -5,10 +5,11 @@ class patch_bus(HardPatch):
     @staticmethod
     def apply_patch():
 
+        import bisect
         import datetime
+        import hashlib
         import json
         import logging
-        import random
         import select
         import threading
         import time
@@ -27,6 +28,23 @@ class patch_bus(HardPatch):
 
         import gevent
         from gevent.event import Event
+        from gevent.lock import Semaphore
+
+        # PATCH !!
+        # Optionally fan out notifications over Redis pub/sub instead
+        # of Postgres NOTIFY, every dyno only subscribes to the channels
+        # it has listeners for.
+        from odooku import redis
+        REDIS_BUS = getattr(params, 'REDIS_BUS', False) and redis.pool is not None
+        REDIS_PREFIX = 'imbus:'
+        # Notifications inserted per statement
+        BUS_INSERT_BATCH = 500
+        # Seconds between garbage collections and rows deleted per statement
+        BUS_GC_INTERVAL = 60
+        BUS_GC_LIMIT = 5000
+        BUS_GC_LOCK = int(hashlib.sha1('bus.bus.gc').hexdigest()[:15], 16)
+        # Recent notifications kept in memory per database
+        BUS_BUFFER_SIZE = 1000
 
         # PATCH !!
         def _get_imbus_db():
@@ -46,6 +64,10 @@ class patch_bus(HardPatch):
                 key = tuple(key)
             return key
 
+        # PATCH !!
+        def redis_channel(dbname, channel):
+            return REDIS_PREFIX + json_dump([dbname, channel])
+
 
         class ImBus(models.Model):
 
@@ -55,35 +77,112 @@ class patch_bus(HardPatch):
             channel = fields.Char('Channel')
             message = fields.Char('Message')
 
+            # PATCH !!
+            @api.model_cr
+            def init(self):
+                self._cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = %s", ('bus_bus_channel_id_index',))
+                if not self._cr.fetchone():
+                    self._cr.execute("CREATE INDEX bus_bus_channel_id_index ON bus_bus (channel, id)")
+
             @api.model
-            def gc(self):
+            def gc(self, limit=BUS_GC_LIMIT):
+                """ Delete at most `limit` expired notifications, returns the number
+                of deleted rows or None when another process is collecting. """
+                # PATCH !!
+                # Set based delete, serialized across processes
+                self._cr.execute("SELECT pg_try_advisory_xact_lock(%s)", (BUS_GC_LOCK,))
+                if not self._cr.fetchone()[0]:
+                    return None
                 timeout_ago = datetime.datetime.utcnow()-datetime.timedelta(seconds=TIMEOUT*2)
-                domain = [('create_date', '<', timeout_ago.strftime(DEFAULT_SERVER_DATETIME_FORMAT))]
-                return self.sudo().search(domain).unlink()
+                self._cr.execute("""
+                    DELETE FROM bus_bus WHERE id IN (
+                        SELECT id FROM bus_bus WHERE create_date < %s LIMIT %s
+                    )
+                """, (timeout_ago.strftime(DEFAULT_SERVER_DATETIME_FORMAT), limit))
+                return self._cr.rowcount
 
             @api.model
             def sendmany(self, notifications):
-                channels = set()
-                for channel, message in notifications:
-                    channels.add(channel)
-                    values = {
-                        "channel": json_dump(channel),
-                        "message": json_dump(message)
-                    }
-                    self.sudo().create(values)
-                    if random.random() < 0.01:
-                        self.gc()
-                if channels:
+                if not notifications:
+                    return
+
+                # PATCH !!
+                # Insert all notifications with a single statement
+                # per batch instead of a create per notification.
+                rows = list(notifications)
+                ids = []
+                for index in xrange(0, len(rows), BUS_INSERT_BATCH):
+                    batch = rows[index:index + BUS_INSERT_BATCH]
+                    values = []
+                    for channel, message in batch:
+                        values += [json_dump(channel), json_dump(message), SUPERUSER_ID, SUPERUSER_ID]
+                    self._cr.execute("""
+                        INSERT INTO bus_bus (channel, message, create_uid, write_uid, create_date, write_date)
+                        VALUES %s
+                        RETURNING id
+                    """ % ', '.join(["(%s, %s, %s, %s, (now() at time zone 'UTC'), (now() at time zone 'UTC'))"] * len(batch)),
+                    values)
+                    ids += [row[0] for row in self._cr.fetchall()]
+
+                # PATCH !!
+                # Notify once per transaction, no matter how many times
+                # notifications were sent.
+                cr = self._cr
+                pending = getattr(cr, '_bus_pending', None)
+                if pending is None:
+                    pending = cr._bus_pending = {}
+                    cr.after('commit', lambda: self._bus_commit(cr.__dict__.pop('_bus_pending', None)))
+                    cr.after('rollback', lambda: cr.__dict__.pop('_bus_pending', None))
+
+                for notification_id, (channel, message) in zip(ids, rows):
+                    pending.setdefault(redis_channel(cr.dbname, channel), []).append({
+                        'id': notification_id,
+                        'channel': channel,
+                        'message': message
+                    })
+
+            def _bus_commit(self, pending):
+                if not pending:
+                    return
+                if REDIS_BUS:
+                    # PATCH !!
+                    # Notifications are published along with their content,
+                    # listeners do not have to read them back.
+                    pipe = redis.pool.client.pipeline(transaction=False)
+                    for name, data in pending.iteritems():
+                        pipe.publish(name, json_dump(data))
+                    pipe.execute()
+                else:
                     # We have to wait until the notifications are commited in database.
                     # When calling `NOTIFY imbus`, some concurrent threads will be
                     # awakened and will fetch the notification in the bus table. If the
                     # transaction is not commited yet, there will be nothing to fetch,
                     # and the longpolling will return no notification.
-                    def notify():
-                        # PATCH !!
-                        with odoo.sql_db.db_connect(_get_imbus_db()).cursor() as cr:
-                            cr.execute("notify imbus, %s", (json_dump(list(channels)),))
-                    self._cr.after('commit', notify)
+                    channels = [data[0]['channel'] for data in pending.itervalues()]
+                    # PATCH !!
+                    with odoo.sql_db.db_connect(_get_imbus_db()).cursor() as cr:
+                        cr.execute("notify imbus, %s", (json_dump(channels),))
+
+            # PATCH !!
+            @api.model
+            def fetch(self, last, limit, exclude=()):
+                """ Notifications of all channels after `last`, ordered by id """
+                self._cr.execute("""
+                    SELECT id, channel, message FROM bus_bus
+                    WHERE id > %s AND NOT (id = ANY(%s))
+                    ORDER BY id
+                    LIMIT %s
+                """, (last, list(exclude), limit))
+                return [{
+                    'id': notification_id,
+                    'channel': json.loads(channel),
+                    'message': json.loads(message),
+                } for notification_id, channel, message in self._cr.fetchall()]
+
+            @api.model
+            def last_id(self):
+                self._cr.execute("SELECT max(id) FROM bus_bus")
+                return self._cr.fetchone()[0] or 0
 
             @api.model
             def sendone(self, channel, message):
@@ -93,41 +192,112 @@ class patch_bus(HardPatch):
             def poll(self, channels, last=0, options=None, force_status=False):
                 if options is None:
                     options = {}
-                # first poll return the notification in the 'buffer'
-                if last == 0:
-                    timeout_ago = datetime.datetime.utcnow()-datetime.timedelta(seconds=TIMEOUT)
-                    domain = [('create_date', '>', timeout_ago.strftime(DEFAULT_SERVER_DATETIME_FORMAT))]
-                else:  # else returns the unread notifications
-                    domain = [('id', '>', last)]
-                channels = [json_dump(c) for c in channels]
-                domain.append(('channel', 'in', channels))
-                notifications = self.sudo().search_read(domain)
-                # list of notification to return
+                # PATCH !!
+                # Raw query backed by the (channel, id) index, channels
+                # are mapped back without parsing them.
+                channels = dict((json_dump(c), c) for c in channels)
                 result = []
-                for notif in notifications:
-                    result.append({
-                        'id': notif['id'],
-                        'channel': json.loads(notif['channel']),
-                        'message': json.loads(notif['message']),
-                    })
+                if channels:
+                    # first poll return the notification in the 'buffer'
+                    if last == 0:
+                        timeout_ago = datetime.datetime.utcnow()-datetime.timedelta(seconds=TIMEOUT)
+                        self._cr.execute("""
+                            SELECT id, channel, message FROM bus_bus
+                            WHERE channel IN %s AND create_date > %s
+                            ORDER BY id
+                        """, (tuple(channels), timeout_ago.strftime(DEFAULT_SERVER_DATETIME_FORMAT)))
+                    else:  # else returns the unread notifications
+                        self._cr.execute("""
+                            SELECT id, channel, message FROM bus_bus
+                            WHERE channel IN %s AND id > %s
+                            ORDER BY id
+                        """, (tuple(channels), last))
+                    # list of notification to return
+                    for notification_id, channel, message in self._cr.fetchall():
+                        result.append({
+                            'id': notification_id,
+                            'channel': channels[channel],
+                            'message': json.loads(message),
+                        })
 
                 if result or force_status:
                     partner_ids = options.get('bus_presence_partner_ids')
                     if partner_ids:
+                        # PATCH !!
+                        # Read the presence of all partners at once
                         partners = self.env['res.partner'].browse(partner_ids)
                         result += [{
                             'id': -1,
                             'channel': (self._cr.dbname, 'bus.presence'),
-                            'message': {'id': r.id, 'im_status': r.im_status}} for r in partners]
+                            'message': {'id': r['id'], 'im_status': r['im_status']}}
+                            for r in partners.read(['im_status'])]
                 return result
 
 
         #----------------------------------------------------------
         # Dispatcher
         #----------------------------------------------------------
+        # PATCH !!
+        class NotificationBuffer(object):
+            """ Bounded buffer of the most recent notifications of a database,
+            complete for all channels after `start`. Notifications are not
+            comitted in id order, they are kept sorted as they come in. """
+
+            def __init__(self, last, size=BUS_BUFFER_SIZE):
+                self.start = last
+                self.size = size
+                self.lock = Semaphore()
+                self.ids = set()
+                # Sorted (id, notification) pairs, overall and per channel
+                self.notifications = []
+                self.channels = {}
+
+            def extend(self, notifications):
+                for notification in notifications:
+                    if notification['id'] <= self.start or notification['id'] in self.ids:
+                        continue
+                    item = (notification['id'], notification)
+                    self.ids.add(notification['id'])
+                    bisect.insort(self.notifications, item)
+                    bisect.insort(self.channels.setdefault(hashable(notification['channel']), []), item)
+                while len(self.notifications) > self.size:
+                    notification_id, notification = self.notifications.pop(0)
+                    channel = hashable(notification['channel'])
+                    self.channels[channel].pop(0)
+                    if not self.channels[channel]:
+                        del self.channels[channel]
+                    self.ids.discard(notification_id)
+                    self.start = notification_id
+
+            def get(self, channels, last):
+                """ Notifications after `last`, or None when they might
+                no longer be buffered. """
+                if last < self.start:
+                    return None
+                result = []
+                for channel in set(hashable(channel) for channel in channels):
+                    for notification_id, notification in reversed(self.channels.get(channel, ())):
+                        if notification_id <= last:
+                            break
+                        result.append(notification)
+                return sorted(result, key=lambda notification: notification['id'])
+
         class ImDispatch(object):
             def __init__(self):
                 self.channels = {}
+                # PATCH !!
+                # Waiting events to their channels, events are removed
+                # from self.channels once their poll returns.
+                self.waiters = {}
+                # WebSocket subscribers per database
+                self.subscribers = {}
+                # Redis channel names to the number of listeners
+                self.watched = {}
+                self.pubsub = None
+                # Notification buffers per database, only kept
+                # up to date while listening to Postgres.
+                self.buffers = {}
+                self.listening = False
 
             def poll(self, dbname, channels, last, options=None, timeout=TIMEOUT):
                 if options is None:
@@ -144,25 +314,242 @@ class patch_bus(HardPatch):
 
                 registry = odoo.registry(dbname)
 
+                # PATCH !!
+                # WebSocket connections do not wait, future notifications
+                # will be pushed through the socket. Their polls always
+                # include the presence, since presence is never pushed.
+                request = odoo.http.request
+                subscriber = request and getattr(request, 'bus_subscriber', None)
+                force_status = subscriber is not None
+                if subscriber is not None:
+                    # Subscribed before reading, notifications committed
+                    # meanwhile are pushed instead of being missed.
+                    self.subscribe(subscriber, dbname, channels, last)
+
                 # immediatly returns if past notifications exist
-                with registry.cursor() as cr:
-                    env = api.Environment(cr, SUPERUSER_ID, {})
-                    notifications = env['bus.bus'].poll(channels, last, options)
+                # PATCH !!
+                # served from memory when possible
+                notifications = self.buffered(dbname, channels, last, options, force_status=force_status)
+                if notifications is None:
+                    with registry.cursor() as cr:
+                        env = api.Environment(cr, SUPERUSER_ID, {})
+                        notifications = env['bus.bus'].poll(channels, last, options, force_status=force_status)
+                        if self.listening and dbname not in self.buffers:
+                            self.buffers[dbname] = NotificationBuffer(env['bus.bus'].last_id())
+
+                if subscriber is not None:
+                    # Leave out what has been pushed while reading
+                    pushed = subscriber.last
+                    notifications = [n for n in notifications if n['id'] < 0 or n['id'] > pushed]
+                    subscriber.last = max([pushed] + [n['id'] for n in notifications])
+                    return notifications
                 # or wait for future ones
                 if not notifications:
-                    event = self.Event()
-                    for channel in channels:
-                        self.channels.setdefault(hashable(channel), []).append(event)
+                    # PATCH !!
+                    event = self.add_waiter(channels)
+                    if REDIS_BUS:
+                        self.watch(dbname, channels)
                     try:
                         event.wait(timeout=timeout)
-                        with registry.cursor() as cr:
-                            env = api.Environment(cr, SUPERUSER_ID, {})
-                            notifications = env['bus.bus'].poll(channels, last, options, force_status=True)
+                        # PATCH !!
+                        notifications = self.buffered(dbname, channels, last, options, force_status=True)
+                        if notifications is None:
+                            with registry.cursor() as cr:
+                                env = api.Environment(cr, SUPERUSER_ID, {})
+                                notifications = env['bus.bus'].poll(channels, last, options, force_status=True)
                     except Exception:
                         # timeout
                         pass
+                    finally:
+                        self.remove_waiter(event)
+                        if REDIS_BUS:
+                            self.unwatch(dbname, channels)
+                return notifications
+
+            # PATCH !!
+            def add_waiter(self, channels):
+                event = self.Event()
+                channels = set(hashable(channel) for channel in channels)
+                self.waiters[event] = channels
+                for channel in channels:
+                    self.channels.setdefault(channel, set()).add(event)
+                self._gauge()
+                return event
+
+            def remove_waiter(self, event):
+                for channel in self.waiters.pop(event, ()):
+                    events = self.channels.get(channel)
+                    if events is not None:
+                        events.discard(event)
+                        if not events:
+                            del self.channels[channel]
+                self._gauge()
+
+            def wake(self, channels):
+                events = set()
+                for channel in channels:
+                    events.update(self.channels.get(hashable(channel), ()))
+                for event in events:
+                    event.set()
+
+            def _gauge(self):
+                _logger.gauge("bus.waiters", len(self.waiters))
+                _logger.gauge("bus.channels", len(self.channels))
+
+            # PATCH !!
+            def subscribe(self, subscriber, dbname, channels, last):
+                channels = set(hashable(channel) for channel in channels)
+                # Watch the new channels before the previous ones are
+                # unwatched, channels in both are never unsubscribed.
+                if REDIS_BUS:
+                    self.watch(dbname, channels)
+                previous = self._discard(subscriber)
+                if REDIS_BUS and previous:
+                    self.unwatch(subscriber.dbname, subscriber.channels)
+                subscriber.dispatch = self
+                subscriber.dbname = dbname
+                subscriber.channels = channels
+                subscriber.last = max(subscriber.last, last)
+                self.subscribers.setdefault(dbname, set()).add(subscriber)
+
+            def unsubscribe(self, subscriber):
+                if self._discard(subscriber) and REDIS_BUS:
+                    self.unwatch(subscriber.dbname, subscriber.channels)
+
+            def _discard(self, subscriber):
+                subscribers = self.subscribers.get(subscriber.dbname)
+                if subscribers and subscriber in subscribers:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.subscribers[subscriber.dbname]
+                    return True
+                return False
+
+            def watch(self, dbname, channels):
+                """ Subscribe to the Redis channels that did not have
+                any listeners yet. """
+                names = []
+                for channel in channels:
+                    name = redis_channel(dbname, channel)
+                    self.watched[name] = self.watched.get(name, 0) + 1
+                    if self.watched[name] == 1:
+                        names.append(name)
+                if names and self.pubsub:
+                    try:
+                        self.pubsub.subscribe(*names)
+                    except Exception:
+                        # Watched channels are subscribed again on reconnect
+                        _logger.exception("Bus.watch error")
+
+            def unwatch(self, dbname, channels):
+                names = []
+                for channel in channels:
+                    name = redis_channel(dbname, channel)
+                    count = self.watched.get(name, 0) - 1
+                    if count > 0:
+                        self.watched[name] = count
+                    elif self.watched.pop(name, None) is not None:
+                        names.append(name)
+                if names and self.pubsub:
+                    try:
+                        self.pubsub.unsubscribe(*names)
+                    except Exception:
+                        _logger.exception("Bus.unwatch error")
+
+            def notify(self, dbname, channel, notifications):
+                """ Dispatch notifications received through Redis, they
+                are pushed as is to the WebSocket subscribers. """
+                self.wake([channel])
+                for subscriber in list(self.subscribers.get(dbname, ())):
+                    if channel not in subscriber.channels:
+                        continue
+                    pushed = [n for n in notifications if n['id'] > subscriber.last]
+                    if pushed:
+                        subscriber.last = max(n['id'] for n in pushed)
+                        subscriber.send(pushed)
+
+            def buffered(self, dbname, channels, last, options=None, force_status=False):
+                """ Notifications from the buffer of the database, or None
+                when the database has to be polled instead. """
+                buffer = self.buffers.get(dbname)
+                if buffer is None or not last:
+                    return None
+                notifications = buffer.get(channels, last)
+                if notifications is None:
+                    return None
+                if (notifications or force_status) and (options or {}).get('bus_presence_partner_ids'):
+                    # Presence is always read from the database
+                    return None
                 return notifications
 
+            def refresh(self, channels):
+                """ Fetch the new notifications once per database, then wake
+                up the polls and push to the WebSocket subscribers. """
+                for dbname, buffer in self.buffers.items():
+                    try:
+                        with buffer.lock:
+                            with api.Environment.manage():
+                                registry = odoo.registry(dbname)
+                                with registry.cursor() as cr:
+                                    env = api.Environment(cr, SUPERUSER_ID, {})
+                                    # Everything after start is read again, rows comitted
+                                    # after rows with a higher id are picked up as well.
+                                    while True:
+                                        notifications = env['bus.bus'].fetch(buffer.start, buffer.size, buffer.ids)
+                                        buffer.extend(notifications)
+                                        if len(notifications) < buffer.size:
+                                            break
+                    except Exception:
+                        _logger.exception("Bus.refresh error")
+                        if self.buffers.get(dbname) is buffer:
+                            del self.buffers[dbname]
+
+                # dispatch to local threads/greenlets
+                self.wake(channels)
+                if self.subscribers:
+                    self.push(channels)
+
+            def push(self, channels):
+                """ Push notifications to the WebSocket subscribers, served
+                from the buffers or read once per database. """
+                channels = set(hashable(channel) for channel in channels)
+                for dbname, subscribers in self.subscribers.items():
+                    targets = [s for s in subscribers if s.channels & channels]
+                    if not targets:
+                        continue
+
+                    stale = []
+                    for subscriber in targets:
+                        notifications = self.buffered(dbname, subscriber.channels, subscriber.last)
+                        if notifications is None:
+                            stale.append(subscriber)
+                        else:
+                            self._push(subscriber, notifications)
+                    if not stale:
+                        continue
+
+                    with api.Environment.manage():
+                        registry = odoo.registry(dbname)
+                        with registry.cursor() as cr:
+                            env = api.Environment(cr, SUPERUSER_ID, {})
+                            notifications = env['bus.bus'].poll(
+                                list(set.union(*[s.channels & channels for s in stale])),
+                                min(s.last for s in stale)
+                            )
+
+                    for subscriber in stale:
+                        self._push(subscriber, notifications)
+
+            def _push(self, subscriber, notifications):
+                pushed = [
+                    n for n in notifications
+                    if n['id'] > subscriber.last
+                    and hashable(n['channel']) in subscriber.channels
+                ]
+                if pushed:
+                    subscriber.last = max(n['id'] for n in pushed)
+                    subscriber.send(pushed)
+
             def loop(self):
                 """ Dispatch postgres notifications to the relevant polling threads/greenlets """
                 _logger.info("Bus.loop listen imbus on db postgres")
@@ -171,25 +558,72 @@ class patch_bus(HardPatch):
                     conn = cr._cnx
                     cr.execute("listen imbus")
                     cr.commit();
-                    while True:
-                        if select.select([conn], [], [], TIMEOUT) == ([], [], []):
-                            pass
-                        else:
-                            conn.poll()
-                            channels = []
-                            while conn.notifies:
-                                channels.extend(json.loads(conn.notifies.pop().payload))
-                            # dispatch to local threads/greenlets
-                            events = set()
-                            for channel in channels:
-                                events.update(self.channels.pop(hashable(channel), []))
-                            for event in events:
-                                event.set()
+                    # PATCH !!
+                    # Buffers are only complete while listening
+                    self.listening = True
+                    try:
+                        while True:
+                            if select.select([conn], [], [], TIMEOUT) == ([], [], []):
+                                pass
+                            else:
+                                conn.poll()
+                                channels = []
+                                while conn.notifies:
+                                    channels.extend(json.loads(conn.notifies.pop().payload))
+                                gevent.spawn(self.refresh, channels)
+                    finally:
+                        self.listening = False
+                        self.buffers = {}
+
+            def redis_loop(self):
+                """ Dispatch Redis pub/sub messages to the relevant polling greenlets
+                and WebSocket subscribers """
+                _logger.info("Bus.loop subscribe imbus on redis")
+                pubsub = redis.pool.client.pubsub(ignore_subscribe_messages=True)
+                # Keeps listening while no channels are watched
+                pubsub.subscribe(REDIS_PREFIX, *self.watched.keys())
+                self.pubsub = pubsub
+                try:
+                    for message in pubsub.listen():
+                        if message['type'] != 'message' or message['channel'] == REDIS_PREFIX:
+                            continue
+                        dbname, channel = json.loads(message['channel'][len(REDIS_PREFIX):])
+                        self.notify(dbname, hashable(channel), json.loads(message['data']))
+                finally:
+                    self.pubsub = None
+                    pubsub.close()
+
+            # PATCH !!
+            def gc_loop(self):
+                """ Periodically collect expired notifications of every loaded
+                database, senders never pay for the cleanup. """
+                from odoo.modules.registry import Registry
+                while True:
+                    gevent.sleep(BUS_GC_INTERVAL)
+                    for dbname in list(Registry.registries.keys()):
+                        try:
+                            with api.Environment.manage():
+                                registry = odoo.registry(dbname)
+                                if 'bus.bus' not in registry:
+                                    continue
+                                deleted = BUS_GC_LIMIT
+                                while deleted == BUS_GC_LIMIT:
+                                    with registry.cursor() as cr:
+                                        env = api.Environment(cr, SUPERUSER_ID, {})
+                                        deleted = env['bus.bus'].gc(BUS_GC_LIMIT)
+                                    # Yield in between batches
+                                    gevent.sleep(0)
+                        except Exception:
+                            _logger.exception("Bus.gc error")
 
             def run(self):
                 while True:
                     try:
-                        self.loop()
+                        # PATCH !!
+                        if REDIS_BUS:
+                            self.redis_loop()
+                        else:
+                            self.loop()
                     except Exception, e:
                         _logger.exception("Bus.loop error, sleep and retry")
                         time.sleep(TIMEOUT)
@@ -199,6 +633,7 @@ class patch_bus(HardPatch):
                 # Force gevent mode
                 self.Event = Event
                 gevent.spawn(self.run)
+                gevent.spawn(self.gc_loop)
                 return self
 
         dispatch = ImDispatch().start()
@@ -29,7 +29,21 @@ class patch_module_installed(SoftPatch):
 
         from collections import OrderedDict
 
+        # Sorted modules per database, installing or updating modules
+        # results in a new registry or registry sequence.
+        _module_installed = {}
+
         def module_installed(environment):
+            registry = environment.registry
+            cached = _module_installed.get(registry.db_name)
+            if cached and cached[0] is registry and cached[1] == registry.registry_sequence:
+                return list(cached[2])
+
+            sorted_modules = _module_installed_sorted(environment)
+            _module_installed[registry.db_name] = (registry, registry.registry_sequence, sorted_modules)
+            return list(sorted_modules)
+
+        def _module_installed_sorted(environment):
             # Candidates module the current heuristic is the /static dir
             loadable = http.addons_manifest.keys()
 
@@ -74,6 +88,75 @@ class patch_clean_attachments(SoftPatch):
         return locals()
 
 
+class patch_single_flight(SoftPatch):
+
+    @staticmethod
+    def apply_patch():
+
+        from gevent.lock import Semaphore
+        from odooku.patch.helpers import patch_class
+
+        # Greenlets generating the same bundle, with
+        # the number of greenlets waiting for the lock.
+        _flights = {}
+
+        @patch_class(globals()['AssetsBundle'])
+        class AssetsBundle(object):
+
+            def _single_flight(self, type, generate):
+                if self.get_attachments(type):
+                    return generate()
+
+                # Only one greenlet per process generates the bundle, while
+                # the others wait for it.
+                key = '%s/%s.%s' % (self.name, self.checksum, type)
+                flight = _flights.setdefault(key, {'lock': Semaphore(), 'waiters': 0})
+                flight['waiters'] += 1
+                try:
+                    with flight['lock']:
+                        return self._generate_committed(key, generate)
+                finally:
+                    flight['waiters'] -= 1
+                    if not flight['waiters'] and _flights.get(key) is flight:
+                        del _flights[key]
+
+            def _generate_committed(self, key, generate):
+                # The snapshot of the request cursor predates any attachments
+                # generated meanwhile. Bundles are generated and comitted on
+                # a separate cursor instead, across processes a session level
+                # advisory lock makes the others wait and re-check.
+                lock_id = int(hashlib.sha1(key).hexdigest()[:15], 16)
+                with self.env.registry.cursor() as cr:
+                    cr.execute("SELECT pg_advisory_lock(%s)", (lock_id,))
+                    try:
+                        # Start a new snapshot now that the lock is held
+                        cr.commit()
+                        env, self.env = self.env, self.env(cr=cr)
+                        try:
+                            attachments = generate()
+                            cr.commit()
+                            # Attachments are returned bound to this cursor,
+                            # their fields are read before it is closed.
+                            attachments.mapped('url')
+                        finally:
+                            self.env = env
+                    except Exception:
+                        cr.rollback()
+                        raise
+                    finally:
+                        cr.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+                return attachments
+
+            def css(self):
+                return self._single_flight('css', self.css_)
+
+            def js(self):
+                return self._single_flight('js', self.js_)
+
+        return locals()
+
+
 patch_checksum('odoo.addons.base.ir.ir_qweb.assetsbundle')
 patch_module_installed('odoo.addons.web.controllers.main')
 patch_clean_attachments('odoo.addons.base.ir.ir_qweb.assetsbundle')
+patch_single_flight('odoo.addons.base.ir.ir_qweb.assetsbundle')
@@ -1,18 +1,25 @@
 import urlparse
 import posixpath
 
+import time
 import logging
+from contextlib import contextmanager
+
 import boto3
 import botocore.session
 from botocore.client import Config
 from botocore.exceptions import ClientError
-from werkzeug.local import Local
+from gevent.queue import LifoQueue, Empty
 
 
 _logger = logging.getLogger(__name__)
 
 
 S3_CACHE_TIME = 3600*24*30
+# Lifetime of presigned urls
+S3_PRESIGNED_TIME = 60*5
+# Maximum number of keys accepted by a single DeleteObjects request
+S3_DELETE_BATCH = 1000
 
 
 class S3Error(Exception):
@@ -28,8 +35,8 @@ class S3Pool(object):
     def __init__(self, bucket, aws_access_key_id=None,
             aws_region=None, aws_secret_access_key=None,
             addressing_style=None, signature_version=None,
-            custom_domain=None, endpoint_url=None):
-        self._local = Local()
+            custom_domain=None, endpoint_url=None,
+            maxconn=None, maxconn_timeout=None):
         self._bucket = bucket
         self._aws_access_key_id = aws_access_key_id
         self._aws_secret_access_key = aws_secret_access_key
@@ -39,12 +46,23 @@ class S3Pool(object):
         self._signature_version = signature_version
         self._custom_domain = custom_domain
 
+        # Process wide pool of clients, shared by all greenlets. Clients
+        # are created lazily up until maxconn, after which a checkout will
+        # block untill another greenlet returns its client.
+        self._maxconn = maxconn or 10
+        self._maxconn_timeout = maxconn_timeout or 20
+        self._clients = LifoQueue()
+        self._num_clients = 0
+        self._session = None
+        self._resolved_endpoint_url = None
+
     def check(self):
         # Wont work for fake-s3
         '''
         try:
             _logger.info("S3 (%s) head", self.bucket)
-            self.client.head_bucket(Bucket=self.bucket)
+            with self.checkout() as client:
+                client.head_bucket(Bucket=self.bucket)
         except ClientError as e:
             _logger.warning("S3 (%s) head", self.bucket, exc_info=True)
             return False
@@ -54,29 +72,116 @@ class S3Pool(object):
     def get_url(self, *parts):
         if self._custom_domain:
             return urlparse.urljoin(self._custom_domain, posixpath.join(*parts))
-        return urlparse.urljoin(self.client.meta.endpoint_url, posixpath.join(self.bucket, *parts))
+        return urlparse.urljoin(self.endpoint_url, posixpath.join(self.bucket, *parts))
+
+    def get_presigned_url(self, key, expires_in=S3_PRESIGNED_TIME, **params):
+        params.update(Bucket=self.bucket, Key=key)
+        with self.checkout() as client:
+            return client.generate_presigned_url(
+                'get_object',
+                Params=params,
+                ExpiresIn=expires_in
+            )
 
     @property
     def bucket(self):
         return self._bucket
 
     @property
-    def client(self):
-        if not hasattr(self._local, 'client'):
-            _logger.info("Creating new S3 Client")
-            self._local.client = boto3.client(
-                's3',
+    def endpoint_url(self):
+        # Resolved once through a client outside of the pool, urls
+        # are rendered often and should not wait for S3 transfers.
+        if self._resolved_endpoint_url is None:
+            self._resolved_endpoint_url = (
+                self._endpoint_url or self._create_client().meta.endpoint_url
+            )
+        return self._resolved_endpoint_url
+
+    @property
+    def maxconn(self):
+        return self._maxconn
+
+    def _create_client(self):
+        if self._session is None:
+            # Share a single session, credentials are only resolved once.
+            self._session = boto3.session.Session(
                 region_name=self._aws_region,
                 aws_access_key_id=self._aws_access_key_id,
-                aws_secret_access_key=self._aws_secret_access_key,
-                endpoint_url=self._endpoint_url,
-                config=Config(
-                    s3={'addressing_style': self._addressing_style},
-                    signature_version=self._signature_version
-                )
+                aws_secret_access_key=self._aws_secret_access_key
+            )
+
+        _logger.info("Creating new S3 Client (%s/%s)", self._num_clients, self._maxconn)
+        return self._session.client(
+            's3',
+            endpoint_url=self._endpoint_url,
+            config=Config(
+                s3={'addressing_style': self._addressing_style},
+                signature_version=self._signature_version
             )
+        )
 
-        return self._local.client
+    def _acquire(self):
+        start = time.time()
+        try:
+            client = self._clients.get_nowait()
+        except Empty:
+            if self._num_clients < self._maxconn:
+                self._num_clients += 1
+                try:
+                    client = self._create_client()
+                except Exception:
+                    self._num_clients -= 1
+                    raise
+            else:
+                try:
+                    client = self._clients.get(timeout=self._maxconn_timeout)
+                except Empty:
+                    _logger.warning("S3 (%s) no client available after %ss", self.bucket, self._maxconn_timeout)
+                    raise S3Error("No S3 client available")
+
+        wait = int(round((time.time() - start) * 1000))
+        _logger.histogram("s3.pool.wait", wait)
+        _logger.gauge("s3.pool.idle", self._clients.qsize())
+        return client
+
+    def _release(self, client):
+        self._clients.put(client)
+
+    def delete_keys(self, keys):
+        """ Delete keys using DeleteObjects, in batches of S3_DELETE_BATCH.
+        Returns the keys that could not be deleted. """
+        failed = []
+        for i in range(0, len(keys), S3_DELETE_BATCH):
+            batch = keys[i:i + S3_DELETE_BATCH]
+            _logger.info("S3 (%s) delete %s keys", self.bucket, len(batch))
+            _logger.increment("s3.delete", len(batch))
+            try:
+                with self.checkout() as client:
+                    r = client.delete_objects(
+                        Bucket=self.bucket,
+                        Delete={
+                            'Objects': [{'Key': key} for key in batch],
+                            'Quiet': True
+                        }
+                    )
+            except (ClientError, S3Error):
+                _logger.warning("S3 (%s) delete %s keys", self.bucket, len(batch), exc_info=True)
+                failed.extend(batch)
+                continue
+
+            for error in r.get('Errors', []):
+                if error['Code'] != "NoSuchKey":
+                    _logger.warning("S3 (%s) delete '%s': %s", self.bucket, error['Key'], error['Message'])
+                    failed.append(error['Key'])
+        return failed
+
+    @contextmanager
+    def checkout(self):
+        client = self._acquire()
+        try:
+            yield client
+        finally:
+            self._release(client)
 
 
 pool = None
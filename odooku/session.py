@@ -9,22 +9,43 @@ SESSION_TIMEOUT = 60*60*24*7 # 7 weeks in seconds
 
 class RedisSessionStore(SessionStore):
 
-    def __init__(self, key_template='session:%s', session_class=None):
+    def __init__(self, key_template='session:%s', version_key_template='session_version:%s',
+            session_class=None):
         super(RedisSessionStore, self).__init__(session_class)
         self._key_template = key_template
+        self._version_key_template = version_key_template
 
     def get_session_key(self, sid):
         if isinstance(sid, unicode):
             sid = sid.encode('utf-8')
         return self._key_template % sid
 
+    def get_version_key(self, sid):
+        if isinstance(sid, unicode):
+            sid = sid.encode('utf-8')
+        return self._version_key_template % sid
+
     def save(self, session):
         key = self.get_session_key(session.sid)
-        if redis.pool.client.set(key, json.dumps(dict(session))):
-            return redis.pool.client.expire(key, SESSION_TIMEOUT)
+        version_key = self.get_version_key(session.sid)
+        pipe = redis.pool.client.pipeline()
+        pipe.set(key, json.dumps(dict(session)))
+        pipe.expire(key, SESSION_TIMEOUT)
+        # Lets long lived connections detect the session has changed
+        pipe.incr(version_key)
+        pipe.expire(version_key, SESSION_TIMEOUT)
+        saved, expires, version, version_expires = pipe.execute()
+        return saved and expires
 
     def delete(self, session):
-        return redis.pool.client.delete(self.get_session_key(session.sid))
+        return redis.pool.client.delete(
+            self.get_session_key(session.sid),
+            self.get_version_key(session.sid)
+        )
+
+    def get_version(self, sid):
+        if self.is_valid_key(sid):
+            return redis.pool.client.get(self.get_version_key(sid))
 
     def get(self, sid):
         if self.is_valid_key(sid):
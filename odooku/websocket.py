@@ -5,11 +5,20 @@ import odoo
 import odoo.http
 from odooku.wsgi import WSGIServer
 from odooku.request import WebRequestMixin
+from odooku.session import RedisSessionStore
+from odooku.params import params
 
 import time
+import heapq
+import itertools
 import gevent
 import json
 import logging
+import psycopg2
+from copy import deepcopy
+
+from gevent.event import Event
+from gevent.lock import Semaphore, BoundedSemaphore
 
 import werkzeug.wrappers
 
@@ -17,6 +26,23 @@ import werkzeug.wrappers
 _logger = logging.getLogger(__name__)
 
 
+# Messages dispatched concurrently per connection, further messages
+# are queued up to WS_MAX_PENDING before being rejected.
+WS_CONCURRENCY = 4
+WS_MAX_PENDING = 32
+# Calls per batch message, every call counts as a pending message
+WS_MAX_BATCH = 10
+# Seconds a message may wait for a database connection slot
+WS_QUEUE_TIMEOUT = 10
+# JSON-RPC server error, the client falls back to http
+WS_BUSY_CODE = -32000
+# Seconds between checks whether the session of a connection has been
+# saved elsewhere, sessions are cached per connection meanwhile.
+WS_SESSION_CHECK = 1
+# Default milliseconds between registry signaling checks per database
+WS_SIGNALING_INTERVAL = 1000
+
+
 class WebSocketRequest(WebRequestMixin, odoo.http.WebRequest):
 
     def __init__(self, httprequest):
@@ -80,16 +106,140 @@ class WebSocketRpcRequest(WebSocketRequest):
             return self._json_response(error=error)
 
 
+class WebSocketBusSubscriber(object):
+    """ Receives the bus notifications of the channels it subscribed
+    to through a longpolling request, see ImDispatch.subscribe. """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.dispatch = None
+        self.dbname = None
+        self.channels = set()
+        self.last = 0
+
+    def send(self, notifications):
+        try:
+            self.ws.send(json.dumps({'bus': notifications}))
+        except WebSocketError:
+            self.close()
+
+    def close(self):
+        if self.dispatch:
+            self.dispatch.unsubscribe(self)
+
+
 class WebSocketChannel(object):
 
-    def __init__(self):
+    def __init__(self, max_concurrency=None):
         self._wss = {}
+        # Every dispatched message requires a database cursor
+        self._max_concurrency = max_concurrency or odoo.tools.config['db_maxconn']
+        self._semaphore = BoundedSemaphore(self._max_concurrency)
+        self._queued = 0
+        # Heap of (deadline, sequence, ws), closed sockets are
+        # skipped once their deadline is reached.
+        self._pings = []
+        self._sequence = itertools.count()
+        self._wakeup = Event()
+        # Database name to time of the last signaling check
+        self._signaling = {}
+        self._signaling_interval = getattr(
+            params, 'WS_SIGNALING_INTERVAL', WS_SIGNALING_INTERVAL) / 1000.0
 
     def _add(self, ws):
-        self._wss[ws] = {}
+        self._wss[ws] = {
+            'semaphore': Semaphore(WS_CONCURRENCY),
+            'pending': 0
+        }
+        # Ping right away, same as before
+        self._schedule_ping(ws, time.time())
+        self._wakeup.set()
 
     def _remove(self, ws):
-        del self._wss[ws]
+        state = self._wss.pop(ws, None)
+        if state and 'subscriber' in state:
+            state['subscriber'].close()
+
+    def _subscriber(self, ws):
+        state = self._wss[ws]
+        if 'subscriber' not in state:
+            state['subscriber'] = WebSocketBusSubscriber(ws)
+        return state['subscriber']
+
+    def _session_version(self, sid):
+        session_store = odoo.http.root.session_store
+        if isinstance(session_store, RedisSessionStore):
+            return session_store.get_version(sid)
+
+    def _session_valid(self, state):
+        session = state.get('session')
+        if session is None or state['session_version'] is None:
+            # Sessions without a version (new or not stored
+            # in Redis) are always resolved again.
+            return False
+
+        now = time.time()
+        if state['session_checked'] + WS_SESSION_CHECK > now:
+            return True
+
+        if self._session_version(session.sid) != state['session_version']:
+            return False
+        state['session_checked'] = now
+        return True
+
+    def get_httprequest(self, ws, environ):
+        # Odoo heavily relies on httprequests, for each message
+        # a new httprequest will be created. This request will be
+        # based on the original environ from the socket initialization
+        # request. Werkzeug requests are merely a wrapper around the
+        # environ, the session (including its database and language)
+        # is resolved once per connection instead.
+        httprequest = werkzeug.wrappers.Request(environ.copy())
+        state = self._wss[ws]
+        if not self._session_valid(state):
+            odoo.http.root.setup_session(httprequest)
+            odoo.http.root.setup_db(httprequest)
+            odoo.http.root.setup_lang(httprequest)
+            sid = httprequest.session.sid
+            version = None if httprequest.session.new else self._session_version(sid)
+            # Version is read after the session, if the session was saved
+            # in between the next check will resolve it again.
+            state.update({
+                'session': httprequest.session,
+                'session_version': version,
+                'session_checked': time.time()
+            })
+        # Messages are dispatched concurrently, each gets its own copy
+        httprequest.session = self._copy_session(state['session'])
+        return httprequest
+
+    def _copy_session(self, session):
+        return odoo.http.root.session_store.session_class(
+            deepcopy(dict(session)), session.sid, session.new)
+
+    def _save_session(self, ws, httprequest):
+        # Same as regular http requests, the copy becomes the
+        # session of the connection.
+        session = httprequest.session
+        if not session.should_save:
+            return
+        odoo.http.root.session_store.save(session)
+        state = self._wss.get(ws)
+        if state is not None:
+            state.update({
+                'session': session,
+                'session_version': self._session_version(session.sid),
+                'session_checked': time.time()
+            })
+
+    def _schedule_ping(self, ws, deadline):
+        heapq.heappush(self._pings, (deadline, next(self._sequence), ws))
+
+    def _copy_httprequest(self, httprequest):
+        # Every call of a batch needs its own path
+        copy = werkzeug.wrappers.Request(httprequest.environ.copy())
+        copy.session = httprequest.session
+        return copy
 
     def get_request(self, httprequest, payload):
         if 'path' in payload:
@@ -99,39 +249,150 @@ class WebSocketChannel(object):
 
     def run_forever(self, ping_delay):
         while True:
-            for ws, state in dict(self._wss).iteritems():
-                if ws.closed:
-                    self._remove(ws)
+            now = time.time()
+            while self._pings and self._pings[0][0] <= now:
+                deadline, sequence, ws = heapq.heappop(self._pings)
+                state = self._wss.get(ws)
+                if state is None:
                     continue
 
                 # Keep socket alive on Heroku (or other platforms).
-                last_ping = state.get('last_ping', None)
-                now = int(round(time.time()))
-                if not last_ping or last_ping + ping_delay < now:
-                    state['last_ping'] = now
-                    try:
-                        ws.send(json.dumps({'ping': now}))
-                    except WebSocketError:
-                        self._remove(ws)
-                        continue
+                state['last_ping'] = int(round(now))
+                try:
+                    ws.send(json.dumps({'ping': state['last_ping']}))
+                except WebSocketError:
+                    self._remove(ws)
+                    continue
+                self._schedule_ping(ws, now + ping_delay)
+
+            # Sleep until the next socket is due, or a new one is added
+            timeout = self._pings[0][0] - now if self._pings else None
+            self._wakeup.clear()
+            self._wakeup.wait(timeout)
+
+    def check_signaling(self, db):
+        # Shared by all greenlets, the first one past the interval
+        # performs the check while the others keep using the registry
+        # as is.
+        now = time.time()
+        if now - self._signaling.get(db, 0) < self._signaling_interval:
+            return
+        self._signaling[db] = now
+        odoo.registry(db).check_signaling()
 
-            gevent.sleep(1)
+    def _dispatch(self, request):
+        try:
+            self.check_signaling(request.session.db)
+            with odoo.tools.mute_logger('odoo.sql_db'):
+                ir_http = request.registry['ir.http']
+        except (AttributeError, psycopg2.OperationalError, psycopg2.ProgrammingError):
+            return {}
+
+        result = ir_http._dispatch()
+        ir_http.pool.signal_caches_change()
+        return result
 
     def dispatch(self, request):
         with odoo.api.Environment.manage():
             with request:
-                try:
-                    odoo.registry(request.session.db).check_signaling()
-                    with odoo.tools.mute_logger('odoo.sql_db'):
-                        ir_http = request.registry['ir.http']
-                except (AttributeError, psycopg2.OperationalError, psycopg2.ProgrammingError):
-                    result = {}
-                else:
-                    result = ir_http._dispatch()
-                    ir_http.pool.signal_caches_change()
+                result = self._dispatch(request)
 
         return result
 
+    def dispatch_batch(self, httprequest, payloads):
+        # All calls share a single cursor, each call still runs in its
+        # own transaction and environments just like separate messages
+        # would. Environment caches are not valid past a rollback.
+        results = []
+        cr = None
+        try:
+            for payload in payloads:
+                request = self.get_request(self._copy_httprequest(httprequest), payload)
+                if not request:
+                    results.append({
+                        'error': {
+                            'message': "Unknown payload"
+                        }
+                    })
+                    continue
+
+                with odoo.api.Environment.manage():
+                    request._cr = cr
+                    with request:
+                        results.append(self._dispatch(request))
+                        # Keep the cursor from being closed on exit
+                        cr, request._cr = request._cr, None
+
+                    if cr:
+                        if request._failed:
+                            cr.rollback()
+                        else:
+                            cr.commit()
+        finally:
+            if cr:
+                cr.close()
+
+        return results
+
+    def _reject(self, ws, message, reason):
+        _logger.increment("ws.rejected", 1)
+        rpc = (message.get('payload') or {}).get('rpc') or {}
+        try:
+            ws.send(json.dumps({
+                'id': message.get('id'),
+                'payload': {
+                    'jsonrpc': '2.0',
+                    'id': rpc.get('id'),
+                    'error': {
+                        'code': WS_BUSY_CODE,
+                        'message': reason
+                    }
+                }
+            }))
+        except WebSocketError:
+            pass
+
+    def _gauge(self):
+        _logger.gauge("ws.queue", self._queued)
+        _logger.gauge("ws.running", self._max_concurrency - self._semaphore.counter)
+
+    def schedule(self, ws, httprequest, message):
+        state = self._wss.get(ws)
+        if state is None:
+            return
+        calls = self._calls(message)
+        if calls > WS_MAX_BATCH:
+            self._reject(ws, message, "Batch too large")
+            return
+        if state['pending'] + calls > WS_MAX_PENDING:
+            self._reject(ws, message, "Too many pending requests")
+            return
+        state['pending'] += calls
+        gevent.spawn(self._respond_queued, ws, state, httprequest, message, calls)
+
+    def _calls(self, message):
+        batch = (message.get('payload') or {}).get('batch')
+        return len(batch) if isinstance(batch, list) else 1
+
+    def _respond_queued(self, ws, state, httprequest, message, calls=1):
+        self._queued += 1
+        self._gauge()
+        try:
+            with state['semaphore']:
+                acquired = self._semaphore.acquire(timeout=WS_QUEUE_TIMEOUT)
+                self._queued -= 1
+                self._gauge()
+                if not acquired:
+                    self._reject(ws, message, "Server busy")
+                    return
+                try:
+                    self.respond(ws, httprequest, message)
+                finally:
+                    self._semaphore.release()
+                    self._gauge()
+        finally:
+            state['pending'] -= calls
+
     def respond(self, ws, httprequest, message):
         if any(key not in message for key in ['id', 'payload']):
             # Invalid message, close connection and abort
@@ -142,49 +403,73 @@ class WebSocketChannel(object):
             'id': message.get('id'),
         }
 
-        request = self.get_request(httprequest, message.get('payload'))
-        if request:
-            payload = self.dispatch(request)
+        payload = message.get('payload')
+        if isinstance(payload.get('batch'), list):
             response.update({
-                'payload': payload
-            })
-        else:
-            response.update({
-                'error': {
-                    'message': "Unknown payload"
+                'payload': {
+                    'batch': self.dispatch_batch(httprequest, payload['batch'])
                 }
             })
-
+        else:
+            request = self.get_request(httprequest, payload)
+            if request and payload.get('subscribe') and ws in self._wss:
+                # Longpolling requests will return right away, further
+                # notifications are pushed through the socket.
+                request.bus_subscriber = self._subscriber(ws)
+
+            if request:
+                response.update({
+                    'payload': self.dispatch(request)
+                })
+            else:
+                response.update({
+                    'error': {
+                        'message': "Unknown payload"
+                    }
+                })
+
+        self._save_session(ws, httprequest)
         try:
             ws.send(json.dumps(response))
         except WebSocketError:
             pass
 
+    def _valid(self, message):
+        if not isinstance(message, dict) or any(key not in message for key in ['id', 'payload']):
+            return False
+        payload = message['payload']
+        if not isinstance(payload, dict):
+            return False
+        batch = payload.get('batch')
+        return batch is None or (
+            isinstance(batch, list)
+            and all(isinstance(item, dict) for item in batch)
+        )
+
     def listen(self, ws, environ):
         self._add(ws)
-        while not ws.closed:
-            try:
-                message = ws.receive()
-            except WebSocketError:
-                break
-
-            if message is not None:
+        try:
+            while not ws.closed:
                 try:
-                    message = json.loads(message)
-                except json.JSONDecodeError:
+                    message = ws.receive()
+                except WebSocketError:
                     break
 
-                # Odoo heavily relies on httprequests, for each message
-                # a new httprequest will be created. This request will be
-                # based on the original environ from the socket initialization
-                # request.
-                httprequest = werkzeug.wrappers.Request(environ.copy())
-                explicit_session = odoo.http.root.setup_session(httprequest)
-                odoo.http.root.setup_db(httprequest)
-                odoo.http.root.setup_lang(httprequest)
-                gevent.spawn(self.respond, ws, httprequest, message)
+                if message is not None:
+                    try:
+                        message = json.loads(message)
+                    except ValueError:
+                        break
+
+                    if not self._valid(message):
+                        # Invalid message, close connection and abort
+                        ws.close()
+                        break
 
-        self._remove(ws)
+                    httprequest = self.get_httprequest(ws, environ)
+                    self.schedule(ws, httprequest, message)
+        finally:
+            self._remove(ws)
 
 
 class WebSocketServer(WSGIServer):
@@ -195,15 +480,21 @@ class WebSocketServer(WSGIServer):
 
     def load(self, *args, **kwargs):
         application = super(WebSocketServer, self).load(*args, **kwargs)
-        _logger.info("Websockets enabled")
-        return WebSocketApplicationWrapper(application, self.timeout)
+        # Regular http requests draw from the same database connections,
+        # websocket messages only get a share of them.
+        max_concurrency = (
+            getattr(params, 'WS_MAX_CONCURRENCY', None)
+            or max(1, self.max_accept // 2)
+        )
+        _logger.info("Websockets enabled (%s concurrent messages)", max_concurrency)
+        return WebSocketApplicationWrapper(application, self.timeout, max_concurrency)
 
 
 class WebSocketApplicationWrapper(object):
 
-    def __init__(self, application, ping_delay=None):
+    def __init__(self, application, ping_delay=None, max_concurrency=None):
         self._application = application
-        self._channel = WebSocketChannel()
+        self._channel = WebSocketChannel(max_concurrency)
         gevent.spawn(self._channel.run_forever, ping_delay)
 
     def __call__(self, environ, start_response):